@@ -0,0 +1,233 @@
+"""
+Local archive of the fetched court list html
+
+Pages are stored content-addressed, gzip-ed, under
+    archive/objects/ab/abcdef....html.gz
+where abcdef... is the sha256 of the page text (utf-8).
+archive/index.sqlite records every fetch keyed by (code, date, fetched_at)
+together with the sha256 and the ETag / Last-Modified sent by the server,
+so a re-fetch can be made conditional.
+
+The index also keeps a negative cache of the (code, date) pairs found to be
+empty ("There is no hearing on this day") or not a court list at all,
+so they are not requested again. Non court list pages are often a
+temporary error page, so those entries expire after NOT_LIST_TTL.
+
+It also records the sha256 of the last page of each (code, date) whose events
+were saved to the DB, see mark_persisted. A page is unchanged when it is
+the same as that one, not as the last fetch, so a page fetched but never
+saved (parse error, failed commit, run killed) is parsed again next time.
+
+Usage:
+python archive.py import ../data    # import the old {code}/{code}_{date}.HTML tree
+python archive.py list [CODE]
+"""
+import sys
+import os
+import re
+import gzip
+import hashlib
+import sqlite3
+import threading
+from glob import glob
+from datetime import datetime
+from datetime import timedelta
+
+ARCHIVE_DIR = "archive"
+
+# negative cache reasons
+NO_HEARING = "no hearing"
+NOT_LIST   = "not court list"
+NOT_LIST_TTL = timedelta(hours=6)
+
+class Archive(object):
+    def __init__(self, root=ARCHIVE_DIR):
+        self.root = root
+        os.makedirs(os.path.join(root, "objects"), exist_ok=True)
+        # fetches happen in worker threads, all access to the index goes through the lock
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(root, "index.sqlite"), check_same_thread=False)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS fetches (
+                code          TEXT NOT NULL,
+                date          TEXT NOT NULL,
+                fetched_at    TEXT NOT NULL,
+                sha256        TEXT NOT NULL,
+                etag          TEXT,
+                last_modified TEXT,
+                PRIMARY KEY (code, date, fetched_at)
+            )""")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS empty_pages (
+                code          TEXT NOT NULL,
+                date          TEXT NOT NULL,
+                reason        TEXT NOT NULL,
+                fetched_at    TEXT NOT NULL,
+                PRIMARY KEY (code, date)
+            )""")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS persisted (
+                code          TEXT NOT NULL,
+                date          TEXT NOT NULL,
+                sha256        TEXT NOT NULL,
+                persisted_at  TEXT NOT NULL,
+                PRIMARY KEY (code, date)
+            )""")
+        self._db.commit()
+
+    def _path(self, sha):
+        return os.path.join(self.root, "objects", sha[:2], sha + ".html.gz")
+
+    def latest(self, code, dateYMD):
+        """
+        the last fetch of (code, dateYMD) as a dict, or None
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT sha256, etag, last_modified, fetched_at FROM fetches "
+                "WHERE code=? AND date=? ORDER BY fetched_at DESC LIMIT 1",
+                (code, dateYMD)).fetchone()
+        if not row: return None
+        return dict(zip(("sha256", "etag", "last_modified", "fetched_at"), row))
+
+    def conditional_headers(self, code, dateYMD):
+        """
+        If-None-Match / If-Modified-Since headers for re-fetching (code, dateYMD)
+        """
+        last = self.latest(code, dateYMD)
+        headers = {}
+        if not last: return headers
+        if last["etag"]         : headers["If-None-Match"]     = last["etag"]
+        if last["last_modified"]: headers["If-Modified-Since"] = last["last_modified"]
+        return headers
+
+    def get(self, sha):
+        with gzip.open(self._path(sha), 'rb') as f:
+            return f.read().decode("utf-8")
+
+    def read(self, code, dateYMD):
+        """
+        text of the last fetch of (code, dateYMD), or None
+        """
+        last = self.latest(code, dateYMD)
+        if not last: return None
+        return self.get(last["sha256"])
+
+    def put(self, code, dateYMD, text, etag=None, last_modified=None, fetched_at=None):
+        """
+        store a fetched page
+        returns (sha256, changed), changed is False if the text is the same as the last fetch
+        """
+        data = text.encode("utf-8")
+        sha = text_sha(text)
+        path = self._path(sha)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmpPath = "%s.%d.tmp" % (path, threading.get_ident())
+            with open(tmpPath, 'wb') as f:
+                f.write(gzip.compress(data))
+            os.replace(tmpPath, path)
+
+        last = self.latest(code, dateYMD)
+        changed = (last is None) or (last["sha256"] != sha)
+        self.record(code, dateYMD, sha, etag, last_modified, fetched_at)
+        return sha, changed
+
+    def record(self, code, dateYMD, sha, etag=None, last_modified=None, fetched_at=None):
+        """
+        add a row to the index, for a fetch whose content is already stored
+        """
+        if fetched_at is None: fetched_at = datetime.utcnow().isoformat()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO fetches VALUES (?,?,?,?,?,?)",
+                (code, dateYMD, fetched_at, sha, etag, last_modified))
+            self._db.commit()
+
+    def mark_persisted(self, code, dateYMD, sha):
+        """
+        the events of the page of sha256 sha are saved to the DB for (code, dateYMD)
+        """
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO persisted VALUES (?,?,?,?)",
+                (code, dateYMD, sha, datetime.utcnow().isoformat()))
+            self._db.commit()
+
+    def persisted_sha(self, code, dateYMD):
+        """
+        sha256 of the last page of (code, dateYMD) saved to the DB, or None
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT sha256 FROM persisted WHERE code=? AND date=?", (code, dateYMD)).fetchone()
+        return row[0] if row else None
+
+    def mark_empty(self, code, dateYMD, reason):
+        """
+        add (code, dateYMD) to the negative cache
+        """
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO empty_pages VALUES (?,?,?,?)",
+                (code, dateYMD, reason, datetime.utcnow().isoformat()))
+            self._db.commit()
+
+    def empty_reason(self, code, dateYMD):
+        """
+        the reason (code, dateYMD) is in the negative cache, or None
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT reason, fetched_at FROM empty_pages WHERE code=? AND date=?",
+                (code, dateYMD)).fetchone()
+        if not row: return None
+        reason, fetched_at = row
+        if reason == NOT_LIST and datetime.utcnow() - datetime.fromisoformat(fetched_at) > NOT_LIST_TTL:
+            return None
+        return reason
+
+    def pairs(self, code=None):
+        """
+        sorted list of archived (code, dateYMD)
+        """
+        with self._lock:
+            if code:
+                rows = self._db.execute("SELECT DISTINCT code, date FROM fetches WHERE code=?", (code,)).fetchall()
+            else:
+                rows = self._db.execute("SELECT DISTINCT code, date FROM fetches").fetchall()
+        return sorted(rows)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+def text_sha(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def import_tree(archive, dataDir):
+    """
+    import a {code}/{code}_{yyyymmdd}.HTML tree, e.g. ../data
+    """
+    n = 0
+    for filePath in sorted(glob(os.path.join(dataDir, "*", "*_*.HTML"))):
+        code = os.path.basename(os.path.dirname(filePath)).upper()
+        dates = re.findall("[0-9]{8}", os.path.basename(filePath))
+        if not dates: continue
+        with open(filePath, 'r') as f:
+            text = f.read()
+        mtime = datetime.utcfromtimestamp(os.path.getmtime(filePath)).isoformat()
+        archive.put(code, dates[0], text, fetched_at=mtime)
+        n += 1
+    return n
+
+if __name__=="__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "import":
+        archive = Archive()
+        print ("Imported %d pages" % import_tree(archive, sys.argv[2]))
+
+    if len(sys.argv) >= 2 and sys.argv[1] == "list":
+        archive = Archive()
+        code = sys.argv[2].upper() if len(sys.argv) == 3 else None
+        for code, dateYMD in archive.pairs(code):
+            print (code, dateYMD)
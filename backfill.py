@@ -0,0 +1,106 @@
+"""
+Historical backfill over a date range x court codes
+
+Usage (via scraper.py):
+python scraper.py backfill 20180101 20181231 [CODE ...]
+
+Each (code, date) pair is a work item. Pairs already having events in the DB
+or already listed in the checkpoint file are skipped, so an interrupted
+backfill can be resumed by running the same command again.
+"""
+import os
+from datetime import datetime
+from datetime import timedelta
+
+from sqlalchemy import func
+
+import dataModel as dm
+import fetcher
+import persist
+import pipeline
+
+CHECKPOINT_PATH = "backfill.ckpt"
+
+class Checkpoint(object):
+    """
+    append only file of "CODE YYYYMMDD" lines, one per finished pair
+    each line is fsync-ed so a crash never loses a finished pair
+    """
+    def __init__(self, path=CHECKPOINT_PATH):
+        self.path = path
+        self.done = set()
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts)==2: self.done.add( (parts[0], parts[1]) )
+        self._f = open(path, 'a')
+
+    def __contains__(self, pair):
+        return pair in self.done
+
+    def mark(self, code, dateYMD):
+        self.done.add( (code, dateYMD) )
+        self._f.write("%s %s\n"%(code, dateYMD))
+        self._f.flush()
+        os.fsync(self._f.fileno())
+
+    def close(self):
+        self._f.close()
+
+def date_range(startYMD, endYMD):
+    """
+    all dates from startYMD to endYMD inclusive
+    """
+    start = datetime.strptime(startYMD, "%Y%m%d").date()
+    end   = datetime.strptime(endYMD  , "%Y%m%d").date()
+    dates = []
+    while start <= end:
+        dates.append(start)
+        start += timedelta(days=1)
+    return dates
+
+def pairs_in_db():
+    """
+    set of (category, yyyymmdd) that already have events
+    """
+    day = func.strftime("%Y%m%d", dm.Event.datetime)
+    rows = dm.session.query(dm.Event.category, day).distinct().all()
+    return set( (cat, d) for cat, d in rows )
+
+def plan(codes, startYMD, endYMD, checkpoint):
+    """
+    list of (code, dateObj) still to be done
+    """
+    existing = pairs_in_db()
+    jobs = []
+    for dateObj in date_range(startYMD, endYMD):
+        dateYMD = datetime.strftime(dateObj, "%Y%m%d")
+        for code in codes:
+            pair = (code, dateYMD)
+            if pair in existing or pair in checkpoint: continue
+            jobs.append( (code, dateObj) )
+    return jobs
+
+def run(codes, startYMD, endYMD, hide_parties=True, concurrency=fetcher.DEFAULT_CONCURRENCY, checkpointPath=CHECKPOINT_PATH, archive=None, workers=None,
+        batchSize=persist.BATCH_SIZE):
+    """
+    fetch, parse and save every pair not done yet
+    events are committed every batchSize, a pair is checkpointed once its events are committed
+    returns the fetch latencies, see fetcher.fetch_all
+    """
+    checkpoint = Checkpoint(checkpointPath)
+    jobs = plan(codes, startYMD, endYMD, checkpoint)
+    print ("Backfill %s-%s: %d pairs to fetch, %d done already"%(startYMD, endYMD, len(jobs), len(checkpoint.done)))
+
+    def on_done(code, dateYMD, status, nEvents):
+        if status != "fail": checkpoint.mark(code, dateYMD)
+
+    try:
+        # pairs not yet done must be parsed even if the archive already has the same page
+        source = pipeline.fetch_source(jobs, concurrency=concurrency, archive=archive, skip_unchanged=False)
+        latencies, nPages, nEvents = pipeline.run(source, hide_parties=hide_parties, workers=workers, on_done=on_done, batchSize=batchSize,
+                                                  archive=archive)
+    finally:
+        checkpoint.close()
+    return latencies
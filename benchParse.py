@@ -0,0 +1,198 @@
+"""
+Parse benchmark over the golden corpus
+
+corpus/ holds a synthetic court list page for every transit_map layout:
+    BP    : 2M_4C
+    DC    : 7C
+    KCMAG : 2M_5C
+    FMC   : FMC
+and corpus/golden.json the events courtParser.parse_records gave for each of them.
+
+For each page this checks the events are still the golden ones, and measures
+the parse time (best of --repeat), events/sec and the peak memory of a parse.
+The memory is the growth of the peak RSS of a process parsing the page once,
+so it counts what libxml2 allocates for lxml too, not only python objects.
+The exit code is 1 if any output differs, or if a page got slower or used more
+memory than its baseline by more than the thresholds, so parser performance
+work can be checked with one command.
+
+The timings depend on the machine, the baseline is not checked in,
+save one with --save before the change, then run without it after.
+
+Usage:
+python benchParse.py [--backend lxml] [--repeat 20] [--save] [--max-slowdown 0.25] [--max-memory-growth 0.25]
+python benchParse.py --update   # after an intended output change, rewrite golden.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from glob import glob
+
+import courtParser as cp
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus")
+GOLDEN_PATH = os.path.join(CORPUS_DIR, "golden.json")
+
+def corpus_pages(corpusDir=CORPUS_DIR):
+    """
+    list of (code, dateYMD, path) of the pages in corpusDir, named CODE_YYYYMMDD.HTML
+    """
+    pages = []
+    for path in sorted(glob(os.path.join(corpusDir, "*.HTML"))):
+        code, dateYMD = os.path.basename(path)[:-len(".HTML")].rsplit("_", 1)
+        pages.append( (code, dateYMD, path) )
+    return pages
+
+def record_to_json(rec):
+    d = rec._asdict()
+    d["datetime"] = rec.datetime.isoformat() if rec.datetime else None
+    # tuples come back from json as lists
+    return json.loads(json.dumps(d))
+
+def quiet_parse(code, dateYMD, text, backend):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return cp.parse_records(code, dateYMD, text, True, backend)
+
+def proc_status(key):
+    """
+    the KB of key, e.g. "VmRSS", in /proc/self/status
+    """
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(key + ":"): return int(line.split()[1])
+
+def peak_rss_growth(code, dateYMD, text, backend):
+    """
+    KB the peak RSS of this process rises above its RSS while parsing the page once
+    run in a fresh process for each page, see page_peak_rss
+    """
+    try:
+        # reset the peak RSS to the current one, the imports peaked higher than a small page does
+        with open("/proc/self/clear_refs", "w") as f: f.write("5")
+    except OSError:
+        # no /proc, ru_maxrss can't be reset so the growth is 0 under the peak of the imports
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        quiet_parse(code, dateYMD, text, backend)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+    before = proc_status("VmRSS")
+    quiet_parse(code, dateYMD, text, backend)
+    return proc_status("VmHWM") - before
+
+def page_peak_rss(path, backend):
+    """
+    peak_rss_growth of the page at path, in a child process, in KB
+    """
+    out = subprocess.run([sys.executable, os.path.abspath(__file__), "--rss-of", path, "--backend", backend],
+                         stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+    return int(out.split()[-1])
+
+def measure(code, dateYMD, path, text, backend, repeat):
+    """
+    returns (records, best sec of repeat parses, peak RSS growth of one parse in KB)
+    """
+    records = quiet_parse(code, dateYMD, text, backend)
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        quiet_parse(code, dateYMD, text, backend)
+        best = min(best, time.perf_counter() - t0)
+    return records, best, page_peak_rss(path, backend)
+
+def diff_events(golden, got):
+    """
+    short description of the first differences, [] if the same
+    """
+    if len(golden) != len(got):
+        return ["%d events, golden has %d" % (len(got), len(golden))]
+    diffs = []
+    for i, (g, e) in enumerate(zip(golden, got)):
+        for k in g:
+            if g[k] != e.get(k): diffs.append("event %d %s: %r, golden %r" % (i, k, e.get(k), g[k]))
+    return diffs[:5]
+
+def write_golden(outputs, path=GOLDEN_PATH):
+    """
+    one event per line, so a change in the output shows up as a readable diff
+    """
+    with open(path, 'w', encoding="utf-8") as f:
+        f.write("{\n")
+        for i, name in enumerate(sorted(outputs)):
+            f.write(' %s: [\n' % json.dumps(name))
+            f.write(",\n".join("  " + json.dumps(e, ensure_ascii=False, sort_keys=True) for e in outputs[name]))
+            f.write("\n ]%s\n" % ("," if i < len(outputs)-1 else ""))
+        f.write("}\n")
+
+def baseline_path(backend):
+    return os.path.join(CORPUS_DIR, "baseline_%s.json" % backend)
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Parse benchmark over the golden corpus")
+    parser.add_argument("--backend"          , default=cp.DEFAULT_BACKEND, help="html backend for courtParser, bs4 or lxml")
+    parser.add_argument("--repeat"           , type=int, default=20, help="parses per page, the best is kept")
+    parser.add_argument("--update"           , action="store_true", help="rewrite golden.json with the current output")
+    parser.add_argument("--save"             , action="store_true", help="save the timings as the baseline of this backend")
+    parser.add_argument("--max-slowdown"     , type=float, default=0.25, help="fail if a page is this much slower than the baseline")
+    parser.add_argument("--max-memory-growth", type=float, default=0.25, help="fail if a page's peak memory grows this much")
+    parser.add_argument("--rss-of"           , default=None, help=argparse.SUPPRESS) # the child process of page_peak_rss
+    args = parser.parse_args()
+
+    if args.rss_of:
+        code, dateYMD = os.path.basename(args.rss_of)[:-len(".HTML")].rsplit("_", 1)
+        with open(args.rss_of, encoding="utf-8") as f: text = f.read()
+        print (peak_rss_growth(code, dateYMD, text, args.backend))
+        raise SystemExit(0)
+
+    golden = {}
+    if os.path.exists(GOLDEN_PATH) and not args.update:
+        with open(GOLDEN_PATH, encoding="utf-8") as f: golden = json.load(f)
+    baseline = {}
+    if os.path.exists(baseline_path(args.backend)) and not args.save:
+        with open(baseline_path(args.backend)) as f: baseline = json.load(f)
+
+    failed = []
+    results = {}
+    outputs = {}
+    totalSec = totalEvents = 0
+    print ("%-22s %7s %10s %12s %10s" % ("page", "events", "ms/page", "events/sec", "+RSS KB"))
+    for code, dateYMD, path in corpus_pages():
+        name = os.path.basename(path)
+        with open(path, encoding="utf-8") as f: text = f.read()
+        records, sec, rss = measure(code, dateYMD, path, text, args.backend, args.repeat)
+        outputs[name] = [record_to_json(r) for r in records]
+        results[name] = {"sec": sec, "rss": rss, "events": len(records)}
+        totalSec += sec
+        totalEvents += len(records)
+        print ("%-22s %7d %10.2f %12.0f %10d" % (name, len(records), sec*1000, len(records)/sec, rss))
+
+        if not args.update:
+            if name not in golden:
+                failed.append("%s: not in golden.json, run with --update" % name)
+            else:
+                failed += ["%s: %s" % (name, d) for d in diff_events(golden[name], outputs[name])]
+        if name in baseline:
+            base = baseline[name]
+            if sec > base["sec"] * (1 + args.max_slowdown):
+                failed.append("%s: %.2fms, baseline %.2fms" % (name, sec*1000, base["sec"]*1000))
+            # baselines saved before the RSS measure have no "rss"
+            if "rss" in base and rss > base["rss"] * (1 + args.max_memory_growth):
+                failed.append("%s: peak RSS +%dKB, baseline +%dKB" % (name, rss, base["rss"]))
+    print ("%-22s %7d %10.2f %12.0f" % ("total", totalEvents, totalSec*1000, totalEvents/totalSec if totalSec else 0))
+
+    if args.update:
+        write_golden(outputs)
+        print ("Golden outputs written to %s" % GOLDEN_PATH)
+    if args.save:
+        with open(baseline_path(args.backend), 'w') as f: json.dump(results, f, indent=1, sort_keys=True)
+        print ("Baseline written to %s" % baseline_path(args.backend))
+    elif not baseline:
+        print ("No baseline for %s, timings not checked, save one with --save" % args.backend)
+
+    for msg in failed: print ("FAIL %s" % msg)
+    if failed: raise SystemExit(1)
+    print ("OK")
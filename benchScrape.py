@@ -0,0 +1,88 @@
+"""
+End-to-end scrape benchmark against the offline replay server
+
+Replays every (code, date) in the archive through replayServer.py and runs
+the full scrape pipeline (fetch -> parse -> persist) on it, into a
+throwaway DB. Reports pages/sec, events/sec and p50/p99 latency per stage.
+
+Usage:
+python benchScrape.py [--archive archive] [--latency 0.2] [--error-rate 0.01] [--max-rps 20]
+                      [--concurrency 8] [--workers 4] [--backend lxml] [--batch-size 500] [--bulk] [--profile daily_scrape]
+                      [--metrics bench.json] [CODE ...]
+
+Also prints where the parse and persist time goes, per metrics.py stage.
+"""
+import argparse
+import math
+import os
+import tempfile
+import time
+from datetime import datetime
+
+import dataModel as dm
+import fetcher
+import metrics
+import pipeline
+import replayServer
+from archive import Archive
+
+def percentile(values, p):
+    """
+    nearest rank percentile, p in 0-100
+    """
+    if not values: return float("nan")
+    values = sorted(values)
+    k = max(0, min(len(values)-1, math.ceil(p/100.0 * len(values)) - 1))
+    return values[k]
+
+def report(name, values):
+    print ("%-8s n=%-5d p50=%8.1fms p99=%8.1fms" % (
+        name, len(values), percentile(values, 50)*1000, percentile(values, 99)*1000))
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="End-to-end scrape benchmark")
+    replayServer.add_arguments(parser)
+    parser.add_argument("--concurrency", type=int, default=fetcher.DEFAULT_CONCURRENCY)
+    parser.add_argument("--workers"    , type=int, default=None, help="parse processes, default: no. of cores")
+    parser.add_argument("--backend"    , default=None, help="html backend for courtParser, bs4 or lxml")
+    parser.add_argument("--batch-size" , type=int, default=None, help="events per commit, default: one commit per page")
+    parser.add_argument("--bulk"       , action="store_true", help="write with bulkPersist.py instead of the ORM")
+    parser.add_argument("--profile"    , default=None, help="sqlite settings, one of dataModel.PROFILES")
+    parser.add_argument("--metrics"    , default=None, help="write the stage timings by court code to this file, .prom or .json")
+    parser.add_argument("codes", nargs="*", help="court codes to replay, default: all")
+    args = parser.parse_args()
+
+    archive = Archive(args.archive)
+    codes = [c.upper() for c in args.codes]
+    jobs = [(code, datetime.strptime(dateYMD, "%Y%m%d").date())
+            for code, dateYMD in archive.pairs()
+            if not codes or code in codes]
+    if not jobs:
+        print ("Nothing in archive %s to replay" % args.archive)
+        raise SystemExit(1)
+
+    server, fetcher.BASE_URL = replayServer.start(archive, latency=args.latency,
+                                                  errorRate=args.error_rate, maxRps=args.max_rps)
+
+    dbDir = tempfile.mkdtemp()
+    dm.init("sqlite:///" + os.path.join(dbDir, "bench.sqlite"), profile=args.profile)
+
+    stats = {}
+    t0 = time.perf_counter()
+    # no archive for the fetcher, every page is downloaded and parsed
+    source = pipeline.fetch_source(jobs, concurrency=args.concurrency)
+    latencies, nPages, nEvents = pipeline.run(source, workers=args.workers, stats=stats, backend=args.backend,
+                                              batchSize=args.batch_size, bulk=args.bulk)
+    elapsed = time.perf_counter() - t0
+    server.shutdown()
+
+    print ("=====================")
+    print ("pages    : %d in %.1fs, %.2f pages/sec" % (nPages , elapsed, nPages /elapsed))
+    print ("events   : %d in %.1fs, %.2f events/sec" % (nEvents, elapsed, nEvents/elapsed))
+    report("fetch"  , [l for _, _, l in latencies if l is not None])
+    report("parse"  , stats["parse"])
+    report("persist", stats["persist"])
+    print ("writer   : %.1f rows/sec" % stats["rows_per_sec"])
+    print ("=====================")
+    print (metrics.summary())
+    metrics.write(args.metrics)
@@ -0,0 +1,327 @@
+"""
+Bulk write path for large imports, e.g. reparse.py of the whole archive
+
+persist.py saves each record through the ORM, an Event and its
+Judge/Case/Tag/Lawyer are flushed one instance at a time under a savepoint.
+Here the records of a batch are resolved in memory instead, then written
+with one executemany per table, on the connection of dm.session,
+of statements built from the SQLAlchemy Core tables:
+    judges, lawyers, tags, cases : INSERT ... ON CONFLICT(id) DO UPDATE,
+                                   the new rows and the renamed / described ones at once
+    events                       : INSERT
+    events_judges, ...           : INSERT ... ON CONFLICT DO NOTHING, the 6 association tables
+
+The names are matched as get_or_create_zh_or_en does, and ids are given
+in the same order the ORM would give them, so the DB is the same as one
+written by persist.BatchWriter. The ids are taken from max(id)+1,
+so the writer must be the only one writing these tables, as for
+dm.IdentityCache. ON CONFLICT needs SQLite 3.24+.
+
+A batch is all or nothing, there is no per record savepoint,
+a batch failing to write is rolled back and counted as failed.
+
+Usage:
+    session = dm.init("sqlite:///data.sqlite")
+    writer = bulkPersist.BulkWriter(500)
+    for records in pages: writer.add(records)
+    writer.commit()
+or
+    ids = bulkPersist.save_records(records)
+"""
+import sqlite3
+import time
+from collections import namedtuple
+from collections import OrderedDict
+
+from sqlalchemy import bindparam
+from sqlalchemy import select
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+
+import dataModel as dm
+import metrics
+import persist
+
+# caseNos per SELECT ... IN, below the 999 bound variables of older SQLite
+QUERY_CHUNK = 500
+
+# as their get_or_create_zh_or_en
+SHORTEN_NAMES = {dm.Judge: False, dm.Lawyer: False, dm.Tag: True}
+
+# (Event field, association table, entity class)
+ASSOCIATIONS = [
+    ("judges"     , dm.events_judges     , dm.Judge ),
+    ("cases"      , dm.events_cases      , dm.Case  ),
+    ("tags"       , dm.events_tags       , dm.Tag   ),
+    ("lawyers"    , dm.events_lawyers    , dm.Lawyer),
+    ("lawyers_atk", dm.events_lawyers_atk, dm.Lawyer),
+    ("lawyers_def", dm.events_lawyers_def, dm.Lawyer),
+]
+
+# ids of what a batch wrote:
+#   events                  : id of the Event of each record, in order
+#   judges, tags, lawyers   : {(name_zh, name_en) as in the records: id}
+#   cases                   : {caseNo: id}
+IdMaps = namedtuple("IdMaps", ["events", "judges", "cases", "tags", "lawyers"])
+
+def insert_sql(table, conflict=None, update=None):
+    """
+    INSERT of all the columns of table, in order, with "?" params
+    with ON CONFLICT(conflict) DO UPDATE SET update, or ON CONFLICT DO NOTHING if conflict is [] and no update
+    """
+    sql = "INSERT INTO %s (%s) VALUES (%s)" % (table.name, ", ".join(c.name for c in table.columns), ", ".join("?" for c in table.columns))
+    if conflict is None: return sql
+    sql += " ON CONFLICT"
+    if conflict: sql += "(%s)" % ", ".join(conflict)
+    if not update: return sql + " DO NOTHING"
+    return sql + " DO UPDATE SET " + ", ".join("%s = excluded.%s" % (c, c) for c in update)
+
+def executemany(conn, table, sql, rows):
+    """
+    run sql for each row, a tuple of the column values of table, in one executemany
+
+    SQLAlchemy's executemany builds a dict of params per row, which takes longer than
+    SQLite inserting it, the tuples go to the DBAPI cursor of conn instead,
+    converted by the bind processors of the column types as SQLAlchemy would
+    """
+    if not rows: return
+    processors = [(i, c.type.dialect_impl(conn.dialect).bind_processor(conn.dialect)) for i, c in enumerate(table.columns)]
+    processors = [(i, p) for i, p in processors if p]
+    if processors:
+        rows = [list(row) for row in rows]
+        for row in rows:
+            for i, p in processors: row[i] = p(row[i])
+    cursor = conn.connection.cursor()
+    try:
+        cursor.executemany(sql, rows)
+    finally:
+        cursor.close()
+
+class BulkWriter(object):
+    """
+    saves pages of records, committing every batchSize events, or once per page if batchSize is None
+    same interface as persist.BatchWriter, the records are only written at commit
+
+    The Judge/Lawyer/Tag names are loaded once, one query per table, and kept
+    as {name: [id, ...]} as dm.IdentityCache does, the Cases of a batch are
+    queried at once, the MAX_CACHED_CASES last used are kept.
+    """
+    def __init__(self, batchSize=persist.BATCH_SIZE):
+        self.batchSize = batchSize
+        self.records = []    # records added since the last commit
+        self.waiting = []    # on_commit of the pages added since the last commit
+        self.rows = 0        # events committed
+        self.failed = 0      # events not saved
+        self.sec = 0.0       # time spent in add() and commit()
+        self.ids = None      # IdMaps of the last commit
+        self.clear()
+
+    def clear(self):
+        self.names = {}              # cls -> {"name_zh": {name: [id, ...]}, "name_en": {...}}
+        self.entities = {}           # cls -> {id: [name_zh, name_en]}
+        self.cases = OrderedDict()   # caseNo -> [id, description], least recently used first
+
+    #===========================================
+    # resolving the records in memory
+    #===========================================
+    def _index(self, cls):
+        if cls not in self.names:
+            self.names[cls] = {"name_zh": {}, "name_en": {}}
+            self.entities[cls] = {}
+            t = cls.__table__
+            for id, name_zh, name_en in dm.session.connection().execute(select([t.c.id, t.c.name_zh, t.c.name_en]).order_by(t.c.id)):
+                self.entities[cls][id] = [name_zh, name_en]
+                self._insert(cls, "name_zh", name_zh, id)
+                self._insert(cls, "name_en", name_en, id)
+        return self.names[cls]
+
+    def _insert(self, cls, attr, name, id):
+        if name is None: return
+        ids = self.names[cls][attr].setdefault(name, [])
+        ids.append(id)
+        if len(ids) > 1: ids.sort()
+
+    def _rename(self, cls, id, attr, name):
+        i = 0 if attr == "name_zh" else 1
+        byName = self.names[cls][attr]
+        old = self.entities[cls][id][i]
+        if old in byName:
+            byName[old].remove(id)
+            if not byName[old]: del byName[old]
+        self.entities[cls][id][i] = name
+        self._insert(cls, attr, name, id)
+
+    def _zh_or_en(self, batch, cls, name_zh, name_en):
+        """
+        id of get_or_create_zh_or_en(cls, name_zh, name_en), the rows to write are added to batch["dirty"][cls]
+        """
+        index = self._index(cls)
+        dirty = batch["dirty"][cls]
+        shorten = SHORTEN_NAMES[cls]
+
+        if name_zh and name_zh in index["name_zh"]:
+            id = index["name_zh"][name_zh][0]
+            old_en = self.entities[cls][id][1]
+            if name_en and ((not old_en) or (shorten and (2<len(name_en)<len(old_en)))):
+                self._rename(cls, id, "name_en", name_en)
+                dirty.add(id)
+            return id
+
+        if name_en and name_en in index["name_en"]:
+            id = index["name_en"][name_en][0]
+            old_zh = self.entities[cls][id][0]
+            if name_zh and ((not old_zh) or (shorten and (1<len(name_zh)<len(old_zh)))):
+                self._rename(cls, id, "name_zh", name_zh)
+                dirty.add(id)
+            return id
+
+        id = batch["next"][cls]
+        batch["next"][cls] += 1
+        self.entities[cls][id] = [name_zh, name_en]
+        self._insert(cls, "name_zh", name_zh, id)
+        self._insert(cls, "name_en", name_en, id)
+        dirty.add(id)
+        return id
+
+    def _load_cases(self, caseNos):
+        # an expanding IN is compiled once, not once per chunk with a bind param per caseNo
+        query = text("SELECT id, caseNo, description FROM cases WHERE caseNo IN :caseNos").bindparams(bindparam("caseNos", expanding=True))
+        missing = [c for c in caseNos if c not in self.cases]
+        for i in range(0, len(missing), QUERY_CHUNK):
+            for id, caseNo, description in dm.session.connection().execute(query, caseNos=missing[i:i+QUERY_CHUNK]):
+                self.cases[caseNo] = [id, description]
+
+    def _case(self, batch, caseNo, desc):
+        """
+        id of dm.Case.get_or_create(caseNo=caseNo), given desc as persist.resolve_record does
+        """
+        case = self.cases.get(caseNo)
+        if case is None:
+            case = self.cases[caseNo] = [batch["next"][dm.Case], None]
+            batch["next"][dm.Case] += 1
+            batch["dirty"][dm.Case].add(caseNo)
+        else:
+            self.cases.move_to_end(caseNo)
+        if desc and case[1] is None:
+            case[1] = desc
+            batch["dirty"][dm.Case].add(caseNo)
+        return case[0]
+
+    def resolve(self, records):
+        """
+        the rows to write for records, as {table: [tuple of column values, ...]}, and their IdMaps
+        """
+        conn = dm.session.connection()
+        def next_id(cls):
+            return (conn.execute(select([cls.__table__.c.id]).order_by(cls.__table__.c.id.desc()).limit(1)).scalar() or 0) + 1
+        batch = {"next" : dict((cls, next_id(cls)) for cls in (dm.Event, dm.Case, dm.Judge, dm.Lawyer, dm.Tag)),
+                 "dirty": dict((cls, set()) for cls in (dm.Case, dm.Judge, dm.Lawyer, dm.Tag))}
+        self._load_cases(persist.unique(caseNo for rec in records for caseNo, _ in rec.cases))
+
+        ids = IdMaps([], {}, {}, {}, {})
+        rows = dict((table, []) for _, table, _ in ASSOCIATIONS)
+        rows[dm.Event.__table__] = events = []
+        eventCols = [c.name for c in dm.Event.__table__.columns]
+        for rec in records:
+            t0 = time.perf_counter()
+            eventId = batch["next"][dm.Event]
+            batch["next"][dm.Event] += 1
+            events.append(tuple(eventId if c == "id" else getattr(rec, c) for c in eventCols))
+            ids.events.append(eventId)
+
+            for field, table, cls in ASSOCIATIONS:
+                if cls is dm.Case:
+                    entityIds = [self._case(batch, caseNo, desc) for caseNo, desc in rec.cases]
+                    ids.cases.update(zip([caseNo for caseNo, _ in rec.cases], entityIds))
+                else:
+                    pairs = getattr(rec, field)
+                    if not pairs: continue
+                    entityIds = [self._zh_or_en(batch, cls, zh, en) for zh, en in pairs]
+                    getattr(ids, cls.__tablename__).update(zip(pairs, entityIds))
+                if len(entityIds) > 1: entityIds = persist.unique(entityIds)
+                # the association tables are (event_id, X_id)
+                rows[table] += [(eventId, id) for id in entityIds]
+            metrics.add("lookup", rec.category, time.perf_counter() - t0)
+
+        for cls in (dm.Judge, dm.Lawyer, dm.Tag):
+            rows[cls.__table__] = [tuple([id] + self.entities[cls][id]) for id in sorted(batch["dirty"][cls])]
+        rows[dm.Case.__table__] = sorted((self.cases[c][0], c, self.cases[c][1]) for c in batch["dirty"][dm.Case])
+        while len(self.cases) > dm.MAX_CACHED_CASES: self.cases.popitem(last=False)
+        return rows, ids
+
+    #===========================================
+    # writing
+    #===========================================
+    def write(self, records):
+        """
+        resolve the records and write them to the current transaction of dm.session, without committing
+        returns their IdMaps
+        """
+        records = list(records)
+        dm.session.flush()
+        rows, ids = self.resolve(records)
+        with metrics.timed("write", metrics.ALL_CODES):
+            conn = dm.session.connection()
+            for cls in (dm.Judge, dm.Lawyer, dm.Tag):
+                executemany(conn, cls.__table__, insert_sql(cls.__table__, ["id"], ["name_zh", "name_en"]), rows[cls.__table__])
+            executemany(conn, dm.Case.__table__, insert_sql(dm.Case.__table__, ["id"], ["description"]), rows[dm.Case.__table__])
+            executemany(conn, dm.Event.__table__, insert_sql(dm.Event.__table__), rows[dm.Event.__table__])
+            for _, table, _ in ASSOCIATIONS:
+                executemany(conn, table, insert_sql(table, []), rows[table])
+        return ids
+
+    def add(self, records, on_commit=None):
+        t0 = time.perf_counter()
+        self.records += records
+        if on_commit: self.waiting.append(on_commit)
+        self.sec += time.perf_counter() - t0
+        if self.batchSize is None or len(self.records) >= self.batchSize:
+            self.commit()
+
+    def commit(self):
+        """
+        write the records added since the last commit and commit them
+        returns False if it failed, the records are then lost
+        """
+        t0 = time.perf_counter()
+        records, self.records = self.records, []
+        try:
+            self.ids = self.write(records)
+        except (SQLAlchemyError, sqlite3.Error) as err:
+            print ("Fail writing %d events: %s"%(len(records), err))
+            dm.session.rollback()
+            self.ids = None
+        ok = self.ids is not None and persist.commit()
+        if ok:
+            self.rows += len(records)
+        else:
+            self.failed += len(records)
+            for rec in records: metrics.count("events_failed", rec.category)
+            # what is kept in memory may not be in the DB
+            self.clear()
+        # the ORM side does not know about the rows written here
+        cache = dm.get_identity_cache()
+        if cache: cache.clear()
+        dm.session.expire_all()
+        waiting, self.waiting = self.waiting, []
+        self.sec += time.perf_counter() - t0
+        for on_commit in waiting: on_commit(ok)
+        return ok
+
+    def rate(self):
+        """
+        events committed per sec spent writing
+        """
+        return self.rows / self.sec if self.sec else 0.0
+
+    def __repr__(self):
+        return "<BulkWriter rows=%d failed=%d %.1f rows/sec>" % (self.rows, self.failed, self.rate())
+
+def save_records(records):
+    """
+    save the records as Events, in one commit
+    returns their IdMaps, None if the commit failed
+    """
+    writer = BulkWriter(None)
+    writer.add(list(records))
+    return writer.ids
@@ -0,0 +1,114 @@
+"""
+Checks bulkPersist.py and dm.IdentityCache write the same DB as the ORM
+
+Parses the pages of corpus/, each read as the list of a few days, and saves
+them into 3 new sqlite DBs, the first day of each page through the ORM
+in all 3, as an existing DB, then the rest with
+    orm     : persist.BatchWriter, no identity cache, the reference
+    cached  : persist.BatchWriter, with dm.IdentityCache
+    bulk    : bulkPersist.BulkWriter
+and compares them table by table, row by row.
+Exits with 1 if a DB differs from the reference.
+
+Usage:
+python checkBulk.py [--backend lxml] [--days 5] [--batch-size 500] [--keep dir]
+"""
+import argparse
+import os
+import shutil
+import sqlite3
+import tempfile
+from datetime import datetime
+from datetime import timedelta
+
+import dataModel as dm
+import persist
+import bulkPersist
+from benchParse import corpus_pages, quiet_parse
+
+def corpus_records(backend, days):
+    """
+    list of the records of each page of the corpus, read for days days from its date
+    the pages of the first day come first
+    """
+    pages = []
+    for day in range(days):
+        for code, dateYMD, path in corpus_pages():
+            with open(path, encoding="utf-8") as f: text = f.read()
+            date = datetime.strptime(dateYMD, "%Y%m%d") + timedelta(days=day)
+            pages.append(quiet_parse(code, date.strftime("%Y%m%d"), text, backend))
+    return pages
+
+def write_db(path, pages, nExisting, writer, identity_cache):
+    """
+    saves pages to a new DB at path, the first nExisting through the ORM, the rest with writer
+    """
+    dm.init("sqlite:///" + path, identity_cache=identity_cache)
+    orm = persist.BatchWriter()
+    for records in pages[:nExisting]: orm.add(records)
+    for records in pages[nExisting:]: writer.add(records)
+    writer.commit()
+    print ("%-7s %s" % (os.path.basename(path)[:-len(".sqlite")], writer))
+    dm.session.close()
+
+def table_rows(path):
+    """
+    table name -> sorted list of its rows
+    """
+    conn = sqlite3.connect(path)
+    tables = [name for name, in conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'")]
+    rows = {name: sorted(conn.execute('SELECT * FROM "%s"' % name).fetchall(), key=repr) for name in tables}
+    conn.close()
+    return rows
+
+def diff_tables(expected, got, show=3):
+    """
+    list of the differences of got from expected, both as given by table_rows
+    """
+    diffs = []
+    for name in sorted(set(expected) | set(got)):
+        if name not in got or name not in expected:
+            diffs.append("%s: table only in %s" % (name, "reference" if name in expected else "this DB"))
+            continue
+        gotRows, expectedRows = set(got[name]), set(expected[name])
+        missing = [r for r in expected[name] if r not in gotRows]
+        extra   = [r for r in got[name] if r not in expectedRows]
+        if missing or extra or len(expected[name]) != len(got[name]):
+            diffs.append("%s: %d rows, reference %d, missing %s, extra %s" % (
+                name, len(got[name]), len(expected[name]), missing[:show], extra[:show]))
+    return diffs
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Check the bulk writer and the identity cache write the same DB as the ORM")
+    parser.add_argument("--backend"   , default=None, help="bs4 or lxml, see htmlBackend.py")
+    parser.add_argument("--days"      , type=int, default=5, help="days each corpus page is read for")
+    parser.add_argument("--batch-size", type=int, default=500, help="events per commit of the writers")
+    parser.add_argument("--keep"      , default=None, help="write the DBs to this dir and keep them")
+    args = parser.parse_args()
+
+    pages = corpus_records(args.backend, args.days)
+    nExisting = len(corpus_pages())
+    print ("%d pages, %d events, the first %d pages through the ORM" % (
+        len(pages), sum(len(p) for p in pages), nExisting))
+
+    dbDir = args.keep or tempfile.mkdtemp()
+    os.makedirs(dbDir, exist_ok=True)
+    writers = [("orm"   , persist.BatchWriter(args.batch_size)       , False),
+               ("cached", persist.BatchWriter(args.batch_size)       , True),
+               ("bulk"  , bulkPersist.BulkWriter(args.batch_size)    , True)]
+    paths = {}
+    for name, writer, identity_cache in writers:
+        paths[name] = os.path.join(dbDir, name + ".sqlite")
+        if os.path.exists(paths[name]): os.remove(paths[name])
+        write_db(paths[name], pages, nExisting, writer, identity_cache)
+
+    reference = table_rows(paths["orm"])
+    failed = False
+    for name in ("cached", "bulk"):
+        diffs = diff_tables(reference, table_rows(paths[name]))
+        print ("%-7s %s" % (name, "same as orm, %d tables" % len(reference) if not diffs else "DIFFERS"))
+        for d in diffs: print ("    " + d)
+        failed = failed or bool(diffs)
+    if not args.keep: shutil.rmtree(dbDir)
+
+    if failed: raise SystemExit(1)
@@ -0,0 +1,83 @@
+"""
+Checks the main queries are served by the indexes of dataModel.py
+
+Runs EXPLAIN QUERY PLAN on the queries of get_or_create*, persist.refresh_page
+and dashboard.py, as SQLAlchemy emits them, and fails if any of them
+scans a whole table. The DB is migrated to the current schema first.
+
+Usage:
+python checkSchema.py [data.sqlite]    # default: a new in-memory DB
+"""
+import argparse
+from datetime import datetime
+
+import dataModel as dm
+
+def main_queries(session):
+    """
+    list of (name, Query) of the queries the scraper and the dashboard run most
+    """
+    queries = []
+    for cls in (dm.Judge, dm.Lawyer, dm.Tag):
+        for attr in ("name_zh", "name_en"):
+            queries.append( ("%s by %s" % (cls.__name__, attr),
+                             session.query(cls).filter_by(**{attr: "x"}).limit(1)) )
+    queries.append( ("Case by caseNo", session.query(dm.Case).filter_by(caseNo="x").limit(1)) )
+
+    day = datetime(2018, 9, 12)
+    queries.append( ("events of a court list",
+                     session.query(dm.Event).filter(dm.Event.category == "DC")
+                                            .filter(dm.Event.datetime >= day)
+                                            .filter(dm.Event.datetime <  day)
+                                            .order_by(dm.Event.id)) )
+    queries.append( ("events of a day", session.query(dm.Event).filter(dm.Event.datetime >= day).filter(dm.Event.datetime < day)) )
+    queries.append( ("events of a court", session.query(dm.Event).filter(dm.Event.court == "x")) )
+
+    # the dynamic relationships, e.g. Tag.events, as they are queried from an instance
+    for name, table, col in [("judge" , dm.events_judges     , "judge_id"),
+                             ("case"  , dm.events_cases      , "case_id"),
+                             ("tag"   , dm.events_tags       , "tag_id"),
+                             ("lawyer", dm.events_lawyers    , "lawyer_id"),
+                             ("lawyer_atk", dm.events_lawyers_atk, "lawyer_id"),
+                             ("lawyer_def", dm.events_lawyers_def, "lawyer_id")]:
+        queries.append( ("events of a %s" % name,
+                         session.query(dm.Event).filter(table.c[col] == 1).filter(table.c.event_id == dm.Event.id)) )
+    queries.append( ("tags of an event",
+                     session.query(dm.Tag).filter(dm.events_tags.c.event_id == 1).filter(dm.events_tags.c.tag_id == dm.Tag.id)) )
+    return queries
+
+def query_plan(session, query):
+    """
+    the detail column of EXPLAIN QUERY PLAN of query
+    """
+    compiled = query.statement.compile(dialect=session.bind.dialect)
+    params = [compiled.params[k] for k in compiled.positiontup]
+    params = [p.isoformat(" ") if isinstance(p, datetime) else p for p in params]
+    cursor = session.connection().connection.cursor()
+    rows = cursor.execute("EXPLAIN QUERY PLAN " + str(compiled), params).fetchall()
+    cursor.close()
+    return [row[-1] for row in rows]
+
+def is_full_scan(detail):
+    # "SCAN TABLE events" before sqlite 3.36, "SCAN events" after, a scan of an index is fine
+    return detail.startswith("SCAN") and "INDEX" not in detail
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Check the main queries use the indexes")
+    parser.add_argument("db", nargs="?", default=None, help="sqlite file, default: a new in-memory DB")
+    args = parser.parse_args()
+
+    session = dm.init("sqlite:///" + args.db if args.db else "sqlite://", identity_cache=False)
+    print ("Schema version %d" % dm.schema_version(session.connection()))
+
+    failed = []
+    for name, query in main_queries(session):
+        plan = query_plan(session, query)
+        scans = [d for d in plan if is_full_scan(d)]
+        print ("%-4s %-24s %s" % ("FAIL" if scans else "ok", name, " | ".join(plan)))
+        if scans: failed.append(name)
+    session.close()
+
+    if failed:
+        print ("Full table scans in: %s" % ", ".join(failed))
+        raise SystemExit(1)
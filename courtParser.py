@@ -1,12 +1,17 @@
 import sys
-from glob import glob
-from bs4 import BeautifulSoup
+import os
 from extractor import Extractor
 import re
 import dataModel as dm
+import htmlBackend
+import layoutRegistry
+import metrics
+import persist
 from collections import OrderedDict
-from sqlalchemy.exc import SQLAlchemyError
+from collections import namedtuple
+from functools import lru_cache
 from datetime import datetime
+from time import perf_counter
 
 # ============================================
 # About the logic flow
@@ -19,10 +24,21 @@ from datetime import datetime
 #   read_row
 #   etc.
 #
-# Depending on the court type, different state machine is used
-# this is specified by transit_map
+# Depending on the layout of the page, different state machine is used
+# the layout is looked up in layouts.json by the page's metadata rows and header,
+# see layoutRegistry.py, transit_map gives the one of each court type if it is unknown
+#
+# The html is accessed through a backend from htmlBackend.py,
+# "bs4" (default) or "lxml" (faster), chosen by the backend arg of parse(...)
+# or the COURT_PARSER_BACKEND env var
+#
+# parse_records(...) does not touch the DB, it returns EventRecord
+# with the judges, cases, tags, lawyers only named.
+# parse(...) is parse_records(...) + persist.save_records(...)
 
 debug = False
+DEFAULT_BACKEND = os.environ.get("COURT_PARSER_BACKEND", "bs4")
+
 def showParseErr(msg):
     if debug:
         raise ValueError(msg)
@@ -36,6 +52,15 @@ FIND_METADATA_FMC_SP = 2
 FIND_HEADER          = 3
 READ_ROW             = 4
 
+# stage names in metrics.py
+STATE_NAMES = {
+    FIND_METADATA        : "find_metadata",
+    FIND_METADATA_MAG    : "find_metadata_mag",
+    FIND_METADATA_FMC_SP : "find_metadata_fmc_sp",
+    FIND_HEADER          : "find_header",
+    READ_ROW             : "read_row",
+}
+
 # transit[currentState][retVal] = nextState
 #2metadata + 4column
 transit_2M_4C = {
@@ -94,6 +119,79 @@ transit_map = {
     "WKMAG" : (transit_2M_5C   , FIND_METADATA_MAG)  ,
 }
 
+#The transit table and init action by layout name, as used in layouts.json
+LAYOUTS = {
+    "2M_4C" : (transit_2M_4C, FIND_METADATA)    ,
+    "7C"    : (transit_7C   , FIND_HEADER)      ,
+    "2M_5C" : (transit_2M_5C, FIND_METADATA_MAG),
+    "FMC"   : (transit_FMC  , FIND_HEADER)      ,
+}
+
+# Versions of the parser, bump when a change alters what a page is parsed to,
+# so its results cached by parseCache.py are dropped
+# PARSER_VERSION for changes to all layouts, e.g. in the column handlers, extractor.py or htmlBackend.py
+# LAYOUT_VERSIONS for changes to one state machine
+PARSER_VERSION = 1
+LAYOUT_VERSIONS = {
+    "2M_4C" : 1,
+    "7C"    : 1,
+    "2M_5C" : 1,
+    "FMC"   : 1,
+}
+
+def parser_version(layout):
+    """
+    version of the parser of a layout
+    """
+    return "%d.%d"%(PARSER_VERSION, LAYOUT_VERSIONS.get(layout, 0))
+
+def layout_of_code(code):
+    """
+    name of the layout transit_map gives court code, None if it has none
+    """
+    for name, (transit, _) in LAYOUTS.items():
+        if code in transit_map and transit_map[code][0] is transit: return name
+    return None
+
+# ============================================
+# Parse result
+# ============================================
+# One hearing, as read from the court list
+# judges / tags / lawyers* : list of (name_zh, name_en), either one could be None
+# cases                    : list of (caseNo, description or None)
+EventRecord = namedtuple("EventRecord", [
+    "category", "court", "datetime", "judges", "cases",
+    "parties", "parties_atk", "parties_def",
+    "tags", "lawyers", "lawyers_atk", "lawyers_def",
+])
+
+# ============================================
+# Precompiled patterns
+# ============================================
+# compiled once at import instead of looked up in re's cache on every call
+RE_SPACES       = re.compile("[\s]+")
+RE_PS_MARKS     = re.compile("[*#]+")
+RE_EN_CHAR      = re.compile('[A-Za-z]')
+RE_NUM_SECTION  = re.compile("[0-9]{1,3}[A-Z]{0,2}[\s(]?[0-9A-Za-z]{1,2}[)\s]?") # 27(a) 104A 8A(1) 16CA(1)etc.
+RE_NUM_LENGTH   = re.compile("[0-9]{1,4}[\s(]*(mm|cm|m|km)?[)\s]*")           # 25mm 10km etc.
+
+RE_CASENO       = re.compile("(?P<caseNo>[A-Z]{2,4}[\s]*[0-9]*/[0-9]{4})")
+RE_CASE_DESC    = re.compile("(?P<desc>[\u4e00-\u9fff.\s]+)")
+RE_TIME         = re.compile("(?P<hh>[0-9]{1,2})[\s]*:[\s]*(?P<mm>[0-9]{1,2})[\s]*(?P<apm>[am|AM|pm|PM]*)")
+RE_COURT        = re.compile("Court[\s]*(?P<target>[A-Za-z0-9.\s]+)")
+RE_COURT_NO     = re.compile("Court No.[\s]*:[\s]*(?P<target>[A-Za-z0-9.\s]+)")
+RE_COURT_NO_MAG = re.compile("(?P<target>No[A-Za-z0-9.\s]+)")
+RE_MASTER       = re.compile("聆案官[\s]*:[\s]*(?P<name_zh>[\u4e00-\u9fff.\s]+)Master[\s]*:[\s]*(?P<name_en>[A-Za-z0-9.\s]+)")
+RE_MAGISTRATE   = re.compile("(?P<name_zh>[\u4e00-\u9fff.,\s]+)(?P<name_en>[A-Za-z0-9.,\-\s]+)")
+RE_JUDGE_FMC    = re.compile("法官[\s]*:[\s]*(?P<name_zh>[\u4e00-\u9fff.,\s]+)" + \
+                             "Judge[\s]*:[\s]*(?P<name_en>[A-Za-z0-9.,\-\s]+)")
+# text that makes a table worth exploding, see irrelevantTable
+# 法庭: metadata, 案件編號 / 案件號碼: header, 首次約見 / 特别程序表: FMC rows without case no., or a case no.
+RE_TABLE_MARKERS = re.compile(u"法[\s]*庭|案件編號|案件號碼|首次約見|特别程序表|[A-Z]{2,4}[\s]*[0-9]*/[0-9]{4}")
+
+#removes (1) (2) 1. 2. etc. at start and end
+RE_TAG_NUMBERING = re.compile("(^{0}|^{1}|{0}$|{1}$)".format("\([0-9]{1,2}\)", "[0-9]{1,2}\."))
+
 # ============================================
 # Utils func
 # ============================================
@@ -102,7 +200,7 @@ def rmAllSpace(s):
     remove all space
     """
     s = s.strip()
-    s = re.sub("[\s]+","", s)
+    s = RE_SPACES.sub("", s)
     return s
 
 def rmDupSpace(s):
@@ -110,21 +208,21 @@ def rmDupSpace(s):
     duplicate space to single space
     """
     s = s.strip()
-    s = re.sub("[\s]+"," ", s)
+    s = RE_SPACES.sub(" ", s)
     return s
 
 def rmPS(s):
     """
     remove * #, i.e. marks used for P.S.
     """
-    s = re.sub("[*#]+","", s)
+    s = RE_PS_MARKS.sub("", s)
     return s
 
 def rmEn(s):
     """
     remove all Eng
     """
-    s = re.sub('[A-Za-z]', '', s)
+    s = RE_EN_CHAR.sub('', s)
     return s
 
 def rmDupElems(l):
@@ -133,34 +231,60 @@ def rmDupElems(l):
     """
     return list(OrderedDict.fromkeys(l))
 
-def rmNeighborDupElems(l):
+def rmDupCases(cases):
+    """
+    rmDupElems for list of (caseNo, desc), the 1st non None desc of a caseNo is kept
+    """
+    d = OrderedDict()
+    for caseNo, desc in cases:
+        if d.get(caseNo) is None: d[caseNo] = desc
+    return list(d.items())
+
+def rmNeighborDupElems(l, same=None):
     """
     [1,1,2,3,1] -> [1,2,3,1]
+    same(a,b) is used to compare elems if given, else ==
     """
     l = l.copy()
     idx = 1
     while idx<len(l):
-        if l[idx]==l[idx-1]:
+        if (same(l[idx], l[idx-1]) if same else l[idx]==l[idx-1]):
             l.pop(idx)
         else:
             idx+=1
     return l
 
+# chars of a numerical / english only token, besides whitespace, for detectLang
+NUMERICAL_CHARS = frozenset(u'[]/()-.0123456789IV"\'〔〕《》（）’ˇＩ')
+EN_TEXT_CHARS   = frozenset(u'[]!@#$%^&*/()+,-.\'"〔〕《》（）’ˇ:' +
+                            u'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789')
+
+def onlyChars(s, chars):
+    """
+    if s is made of chars and whitespace only
+    """
+    for c in s:
+        if c not in chars and not c.isspace(): return False
+    return True
+
+@lru_cache(maxsize=4096)
 def detectLang(s):
+    """
+    "zh", "en", "num" or "nil" for empty s
+    cached, the same names and tags show up on every page
+    """
     s = s.strip()
     if s=="": return "nil"
 
-    nonNumerical = re.sub('[][/()\-.0-9IV\"\'〔〕《》（）’ˇＩ\s]', '', s)
-    if len(nonNumerical)==0: return "num"
+    if onlyChars(s, NUMERICAL_CHARS): return "num"
 
     # 27(a) 104A 8A(1) 16CA(1)etc.
-    if re.fullmatch("[0-9]{1,3}[A-Z]{0,2}[\s(]?[0-9A-Za-z]{1,2}[)\s]?", s): return "num"
+    if RE_NUM_SECTION.fullmatch(s): return "num"
 
     # 25mm 10km etc.
-    if re.fullmatch("[0-9]{1,4}[\s(]*(mm|cm|m|km)?[)\s]*", s): return "num"
+    if RE_NUM_LENGTH.fullmatch(s): return "num"
 
-    nonEnChar = re.sub('[][!@#$%^&*/()\+-.\'\"〔〕《》（）’ˇ:,A-Za-z0-9\s]', '', s)
-    if len(nonEnChar)==0: 
+    if onlyChars(s, EN_TEXT_CHARS): 
         if len(s)<=3 and s.upper() not in ["THE","AND","BUT","AN","CRB"]:
             return "num"  ## "P" in "P"牌, DVD, OK, etc    
         else:
@@ -179,87 +303,192 @@ def getLangPairs(inList, mergeSameLang = False):
     In [24]: getLangPair( ["Lui & Law", "Baker & McKenzie"])
     Out[24]: [(None, 'Lui & Law'), (None, 'Baker & McKenzie')]
     """
-    l = inList.copy()
-    l = [s.strip() for s in l]
+    l = [s.strip() for s in inList]
     
-    # merge nearby same lang tokens
+    # merge nearby same lang tokens, in 1 pass
+    # merged[-1] is the token the next one could be merged into
+    merged = l[:1]
     pos = 1
     while pos<len(l):
         if l[pos]=="":
+            # an empty token, and the one after it, are never merged
+            merged.extend(l[pos:pos+2])
             pos += 2
             continue
         langA = detectLang(l[pos])
-        langB = detectLang(l[pos-1])
+        langB = detectLang(merged[-1])
         if langA=="num" or langB=="num":
-            l[pos-1] += l[pos]
-            del l[pos]
-            continue
-        if mergeSameLang and (langA == langB == 'zh'):
-            l[pos-1] += l[pos]
-            del l[pos]
-            continue
-        if mergeSameLang and (langA == langB == 'en'):
-            l[pos-1] += " " + l[pos] #if eng add space between merge
-            del l[pos]
-            continue
+            merged[-1] += l[pos]
+        elif mergeSameLang and (langA == langB == 'zh'):
+            merged[-1] += l[pos]
+        elif mergeSameLang and (langA == langB == 'en'):
+            merged[-1] += " " + l[pos] #if eng add space between merge
+        else:
+            merged.append(l[pos])
         pos +=1
+    l = merged
     
     # search zh,en pairs
     output = []
-    while l:
-        if (l[0]==""):
-            l.pop(0)
+    pos = 0
+    while pos<len(l):
+        if (l[pos]==""):
+            pos += 1
             continue
 
-        lang0 = detectLang(l[0])
+        lang0 = detectLang(l[pos])
         if lang0=='en':
-            output.append( (None, l[0]) )
-            l.pop(0)
+            output.append( (None, l[pos]) )
+            pos += 1
         elif lang0=='zh':
-            if len(l)>=2 and detectLang(l[1])=='en':
-                output.append( (l[0], l[1]) )
-                l.pop(0)
-                l.pop(0)
+            if pos+1<len(l) and detectLang(l[pos+1])=='en':
+                output.append( (l[pos], l[pos+1]) )
+                pos += 2
             else:
-                output.append( (l[0], None) )
-                l.pop(0)
+                output.append( (l[pos], None) )
+                pos += 1
         else:
             #Should not reach here
             # showParseErr("getLangPairs error: %s" % l)
-            l.pop(0)
+            pos += 1
     if debug: 
         print ("form pair")
         print (inList)
         print (output)
     return output
 
+DEFAULT_TAGS = {
+    'OTD'   : (u"反對自動解除破產"     , "Objections to discharge"),
+    'MIA'   : (u"有關無力償還的雜項申請", "Miscellaneous Insolvency Application"),
+    'O14'   : (u"簡易判決"     , "O.14 List"),
+    'BP'    : (u"破產呈請"     , "Bankruptcy Petition"),
+    'CLCMC' : (u"核對列表聆訊/案件管理會議"     , "Check List/Case Management Conference"),
+    'CRHPI' : (u"核對列表審核聆訊 (人身傷亡案件)"     , "Checklist Review Hearing(PI Cases)"),
+    'CWUP'  : (u"公司清盤呈請"     , "Companies Winding-Up Petition"),
+    'LB'    : (u"勞資審裁處"     , "Labour Tribunal"),
+}
+
 def getDefaultTags(cat):
+    """
+    list of (name_zh, name_en) of the tags all events of cat have
+    """
     cat = cat.upper()
-    d = {
-        'OTD'   : dm.Tag.get_or_create_zh_or_en(name_zh=u"反對自動解除破產"     , name_en="Objections to discharge"),
-        'MIA'   : dm.Tag.get_or_create_zh_or_en(name_zh=u"有關無力償還的雜項申請", name_en="Miscellaneous Insolvency Application"),
-        'O14'   : dm.Tag.get_or_create_zh_or_en(name_zh=u"簡易判決"     , name_en="O.14 List"),
-        'BP'    : dm.Tag.get_or_create_zh_or_en(name_zh=u"破產呈請"     , name_en="Bankruptcy Petition"),
-        'CLCMC' : dm.Tag.get_or_create_zh_or_en(name_zh=u"核對列表聆訊/案件管理會議"     , name_en="Check List/Case Management Conference"),
-        'CRHPI' : dm.Tag.get_or_create_zh_or_en(name_zh=u"核對列表審核聆訊 (人身傷亡案件)"     , name_en="Checklist Review Hearing(PI Cases)"),
-        'CWUP'  : dm.Tag.get_or_create_zh_or_en(name_zh=u"公司清盤呈請"     , name_en="Companies Winding-Up Petition"),
-        'LB'    : dm.Tag.get_or_create_zh_or_en(name_zh=u"勞資審裁處"     , name_en="Labour Tribunal"),
-    }
-    if cat in d: return [d[cat]]
+    if cat in DEFAULT_TAGS: return [DEFAULT_TAGS[cat]]
     return []
 
+#===========================================
+# Layout of a page, see layoutRegistry.py
+#===========================================
+def isHeaderText(s):
+    return u"案件編號" in s or u"案件號碼" in s
+
+def rowKind(texts):
+    """
+    kind of metadata row, None if it is not one
+    texts: stripped text of the cells of the row
+    """
+    first = next((rmAllSpace(s) for s in texts if s), "")
+    if first[:2] == u"法庭":
+        s = " ".join(texts)
+        if RE_MASTER.search(s)   : return "court_master"
+        if RE_JUDGE_FMC.search(s): return "court_judge"
+        if RE_COURT_NO.search(s) : return "court_no"
+        return "court"
+    if first[:3] == u"裁判官": return "magistrate"
+    return None
+
+def irrelevantTable(doc, t):
+    # a table with no metadata, header nor case no. never moves the state machine
+    # or gives an event, e.g. the layout tables around the list
+    return not RE_TABLE_MARKERS.search(doc.text(t))
+
+def explodeTable(doc, t):
+    extractor = Extractor( t )
+    extractor.parse(skip=lambda t: irrelevantTable(doc, t))
+    return extractor.return_list()
+
+def read_layout(tables, cellText):
+    """
+    reads the exploded tables till the one with the 1st header row
+    returns (list of the tables read, kinds of the metadata rows above the header,
+             header names as find_header gets them, None if no header)
+    """
+    read = []
+    metadata = []
+    for table in tables:
+        read.append(table)
+        for row in table:
+            texts = [cellText(cell) for cell in row]
+            if any(isHeaderText(s) for s in texts):
+                return read, metadata, [rmAllSpace(rmEn(s)) for s in texts]
+            kind = rowKind(texts)
+            if kind and kind not in metadata: metadata.append(kind)
+    return read, metadata, None
+
+def page_layout(text, backend=None):
+    """
+    (metadata row kinds, header names) of a page, see read_layout, its events are not parsed
+    """
+    doc = htmlBackend.get(backend or DEFAULT_BACKEND)
+    tables = (explodeTable(doc, t) for t in doc.iter_tables(text))
+    _, metadata, headers = read_layout(tables, lambda cell: doc.text(cell).strip())
+    return metadata, headers
+
+def select_layout(code, metadata, headers, registry=None):
+    """
+    name of the layout to parse a page of court code with, as in the registry
+    an unknown layout is reported and parsed with the one of transit_map[code]
+    None if neither knows how to parse it
+    """
+    registry = registry or layoutRegistry.default()
+    if headers is not None:
+        fp = layoutRegistry.fingerprint(metadata, headers)
+        entry = registry.get(fp)
+        if entry: return entry["layout"]
+        print ("Unknown layout %s of %s, metadata %s, headers %s"%(fp, code, metadata, headers))
+        metrics.count("unknown_layouts", code)
+    return layout_of_code(code)
+
+def layout_of_fingerprint(code, fp, registry=None):
+    """
+    the layout select_layout gives a page of court code with fingerprint fp, without reporting it
+    fp None for a page with no header row
+    """
+    registry = registry or layoutRegistry.default()
+    entry = registry.get(fp) if fp is not None else None
+    return entry["layout"] if entry else layout_of_code(code)
+
 #===========================================
 # The entry point of courtParser
 # For 1st read, I recommend
 # read the main body first then the subfunctions
 #===========================================
-def parse(cat, date, text, hide_parties=True):
+def parse(cat, date, text, hide_parties=True, backend=None):
+    """
+    parse and save the events to dm.session, returns list of dm.Event
+    see parse_records for the args
+    """
+    return persist.save_records(iter_records(cat, date, text, hide_parties, backend))
+
+def parse_records(cat, date, text, hide_parties=True, backend=None, info=None):
     """
     cat: FMC CFA etc
     date: yyyymmdd
     text: html text to parse
     hide_parties: to hide suer/defendent names or not
+    backend: "bs4" or "lxml", see htmlBackend.py, DEFAULT_BACKEND if None
+    info: if a dict, info["layout"] is set to the name of the layout the page is read with
+          and info["fingerprint"] to the layoutRegistry.fingerprint of the page, None if it has no header
+    returns list of EventRecord, no DB needed
+    """
+    return list(iter_records(cat, date, text, hide_parties, backend, info))
+
+def iter_records(cat, date, text, hide_parties=True, backend=None, info=None):
+    """
+    same as parse_records, but yields the EventRecord as soon as they are read
+    only the table being read is kept exploded, so memory stays flat on very long pages
     """
+    doc = htmlBackend.get(backend or DEFAULT_BACKEND)
 
     #"Global vars", their values can be updated in the subfunctions of def parse(...)
 
@@ -278,9 +507,18 @@ def parse(cat, date, text, hide_parties=True):
     lawyers_def = []
 
     headers = []
-    caseColIdx = 0
+    plans = {}     # compiled column plans of the current table, by no. of cells in row, see find_header
+    rowPlans = {}  # plans of rows with colspan cells, by header_map
     rowsRead = 0
 
+    # stripped text of each cell, computed once per table
+    # a colspan / rowspan cell is the same object at every position it covers
+    cellTexts = {}
+    def cellText(cell):
+        key = id(cell)
+        if key not in cellTexts: cellTexts[key] = doc.text(cell).strip()
+        return cellTexts[key]
+
     #===========================================
     # sub functions to be called in the state machine loop
     #===========================================
@@ -290,30 +528,30 @@ def parse(cat, date, text, hide_parties=True):
         nonlocal court
         nonlocal judges
 
-        row = tables[it][ir]
+        row = table[ir]
         
         found = False
         for cell in row:
-            if cell.get_text().strip()[:2] == u"法庭":
+            if cellText(cell)[:2] == u"法庭":
                 found = True
                 break        
         if not found: return 0
 
         for cell in row:
-            s = cell.get_text().strip()
+            s = cellText(cell)
 
             #match court
-            match = re.findall("Court No.[\s]*:[\s]*(?P<target>[A-Za-z0-9.\s]+)", s)
+            match = RE_COURT_NO.findall(s)
             if len(match)>0:
                 court = rmAllSpace(match[0])
                 continue
 
             #match lawyer
-            match = re.findall("聆案官[\s]*:[\s]*(?P<name_zh>[\u4e00-\u9fff.\s]+)Master[\s]*:[\s]*(?P<name_en>[A-Za-z0-9.\s]+)", s)
+            match = RE_MASTER.findall(s)
             if len(match)>0:
                 name_zh = rmAllSpace(match[0][0])
                 name_en = rmDupSpace(match[0][1])
-                judge = dm.Judge.get_or_create_zh_or_en(name_zh=name_zh, name_en=name_en)
+                judge = (name_zh, name_en)
                 judges = [judge] 
                 continue
         if debug: print (court, judge)
@@ -325,35 +563,35 @@ def parse(cat, date, text, hide_parties=True):
         nonlocal court
         nonlocal judges
 
-        row = tables[it][ir]
+        row = table[ir]
         
         found = False
         ic = 0
         for ic,cell in enumerate(row):
-            if rmAllSpace(cell.get_text())[:2] == u"法庭":
+            if rmAllSpace(cellText(cell))[:2] == u"法庭":
                 found = True
                 break        
         if not found: return 0
         
-        cell = tables[it][ir][ic+2]
-        s = cell.get_text().strip()
+        cell = table[ir][ic+2]
+        s = cellText(cell)
 
         #match court
-        match = re.findall("(?P<target>No[A-Za-z0-9.\s]+)", s)
+        match = RE_COURT_NO_MAG.findall(s)
         if len(match)>0:
             court = rmAllSpace(match[0])
         else:
             showParseErr("Parse court failed: %s"%s)
 
-        cell = tables[it][ir+1][ic+2]
-        s = cell.get_text().strip()
+        cell = table[ir+1][ic+2]
+        s = cellText(cell)
 
         #match lawyer
-        match = re.findall("(?P<name_zh>[\u4e00-\u9fff.,\s]+)(?P<name_en>[A-Za-z0-9.,\-\s]+)", s)
+        match = RE_MAGISTRATE.findall(s)
         if len(match)>0:
             name_zh = rmAllSpace(match[0][0])
             name_en = rmDupSpace(match[0][1])
-            judge = dm.Judge.get_or_create_zh_or_en(name_zh=name_zh, name_en=name_en)
+            judge = (name_zh, name_en)
             judges = [judge] 
         elif s.strip("*")=="":
             # On ETNMAG_20180816.HTML, there is 
@@ -371,51 +609,208 @@ def parse(cat, date, text, hide_parties=True):
         nonlocal court
         nonlocal judges
 
-        row = tables[it][ir]
+        row = table[ir]
         
         found = False
         ic = 0
         for ic,cell in enumerate(row):
-            if rmAllSpace(cell.get_text())[:2] == u"法庭":
+            if rmAllSpace(cellText(cell))[:2] == u"法庭":
                 found = True
                 break        
         if not found: return 0
         
-        cell = tables[it][ir][ic]
-        s = cell.get_text().strip()
+        cell = table[ir][ic]
+        s = cellText(cell)
 
         #match court
-        match = re.findall("(?P<target>No[A-Za-z0-9.\s]+)", s)
+        match = RE_COURT_NO_MAG.findall(s)
         if len(match)>0:
             court = rmAllSpace(match[0])
         else:
             showParseErr("Parse court failed: %s"%s)
 
         #match lawyer
-        pattern = "法官[\s]*:[\s]*(?P<name_zh>[\u4e00-\u9fff.,\s]+)" + \
-                  "Judge[\s]*:[\s]*(?P<name_en>[A-Za-z0-9.,\-\s]+)"
-        match = re.findall(pattern, s)
+        match = RE_JUDGE_FMC.findall(s)
         if len(match)>0:
             name_zh = rmAllSpace(match[0][0])
             name_en = rmDupSpace(match[0][1])
-            judge = dm.Judge.get_or_create_zh_or_en(name_zh=name_zh, name_en=name_en)
+            judge = (name_zh, name_en)
             judges = [judge] 
         else:
             showParseErr("Parse judge failed: %s"%s)
         if debug: print (court, judge)
         return 1 # metadata found and parsed
 
+    #===========================================
+    # column handlers of read_row, one per kind of header
+    # handler(s, cell, fields)
+    #   s      : stripped text of cell, never empty
+    #   fields : dict of the lists being filled for the current event
+    #===========================================
+    def read_court(s, cell, fields):
+        nonlocal court
+        match = []
+        if not match: match = ["The Court"] if "The Court" in s else []
+        if not match: match = ["Court of Final Appeal"] if "Court of Final Appeal" in s else []    
+        if not match: match = RE_COURT.findall(s)
+        if not match: 
+            showParseErr('Error parsing court: %s'%s)
+            return
+        court = rmAllSpace(match[0])
+
+    def read_judges(s, cell, fields):
+        ps = [rmDupSpace(doc.text(p)) for p in doc.ps(cell)]
+        langPairs = getLangPairs(ps, mergeSameLang=True)
+        
+        for pair in langPairs:
+            name_zh = rmPS(rmAllSpace(pair[0])) if pair[0] else None
+            name_en = rmPS(rmDupSpace(pair[1])) if pair[1] else None
+            fields["judges"].append( (name_zh, name_en) )
+
+    def read_time(s, cell, fields):
+        nonlocal time
+        match = RE_TIME.findall(s)
+        if not match: 
+            showParseErr('Error parsing time: %s'%s)
+            return
+        hh,mm,apm = match[0]
+        hh = int(hh)
+        mm = int(mm)
+        if 'pm' in apm.lower() and hh<12: hh+=12
+        time = "%02d%02d"%(hh,mm)
+
+    def read_cases(s, cell, fields):
+        caseNos = []
+        if not caseNos: caseNos = RE_CASENO.findall(s)
+        if not caseNos: caseNos = ["FCMC0000/0000"] if (u"首次約見" in s) or (u"特别程序表" in s ) else []
+        if not caseNos: 
+            showParseErr('Error parsing caseNo: %s'%s)
+            return
+
+        caseNos = [rmAllSpace(c) for c in caseNos]
+        
+        #chinese desciption of the caseNo, if avaialable
+        desc = RE_CASE_DESC.findall(s)
+        desc = rmDupSpace(desc[0]) if desc else None
+        
+        for caseNo in caseNos:
+            fields["cases"].append( (caseNo, desc) )
+
+    def read_parties(s, cell, fields):
+        ps = [rmDupSpace(doc.text(p)) for p in doc.ps(cell)]
+        
+        splitPos = None
+
+        # we can separate the parties to atk and def when...
+        # If just 1 'And' appear
+        andPos = [i for i,p in enumerate(ps) if (p=="AND" or p=="And")]
+        if len(andPos)==1 : splitPos = andPos[0] 
+
+        # If its a Criminal case where atk is gov
+        if rmAllSpace(ps[0])==u"HKSAR(香港特別行政區)v.": splitPos = 0
+
+        for i,p in enumerate(ps):
+            if (p=="AND" or p=="And"): continue
+            party = rmDupSpace( p.strip("RE:").strip("Re:").strip("v.") )
+            if splitPos is not None:
+                if i<=splitPos: 
+                    fields["parties_atk"].append(party)
+                else: 
+                    fields["parties_def"].append(party)
+            else:
+                fields["parties"].append(party)
+
+    def read_parties_def(s, cell, fields):
+        ps = [rmDupSpace(doc.text(p)) for p in doc.ps(cell)]
+        for p in ps:
+            party = rmDupSpace(p)
+            fields["parties_def"].append(party)
+
+    def read_tags(s, cell, fields):
+        ps = doc.ps(cell)
+        if len(ps)==1:
+            #sometimes they use <\br> instead of multiple <p> 
+            ps = doc.lines(ps[0]) 
+        else:
+            ps = [doc.text(p) for p in ps]
+        ps = [rmDupSpace(p) for p in ps]
+        if debug: print("ps@性質", ps)
+        langPairs = getLangPairs(ps, mergeSameLang=True)
+        
+        for pair in langPairs:
+            #removes (1) (2) 1. 2. etc. at start and end
+            name_zh = rmAllSpace(RE_TAG_NUMBERING.sub("", pair[0])) if pair[0] else None
+            name_en = rmDupSpace(RE_TAG_NUMBERING.sub("", pair[1])) if pair[1] else None
+
+            fields["tags"].append( (name_zh, name_en) )
+
+    def read_lawyers(s, cell, fields):
+        ps = [rmDupSpace(doc.text(p)) for p in doc.ps(cell)]
+
+        #strip away all text after "parties in person"
+        endPos = [i for i,p in enumerate(ps) if "parties in person" in p.lower()]
+        if len(endPos)>0 : ps = ps[0:endPos[0]]
+
+        # if debug: print("ps@應訊代表", ps)
+        langPairs = getLangPairs(ps)
+        
+        for pair in langPairs:
+            name_zh = pair[0] if pair[0] else None
+            name_en = pair[1] if pair[1] else None
+            fields["lawyers"].append( (name_zh, name_en) )
+
+    def skip_column(s, cell, fields):
+        pass
+
+    def unknown_column(header):
+        def handler(s, cell, fields):
+            showParseErr("Unknown header: %s" % header)
+        return handler
+
+    column_handlers = {
+        u"法庭"           : read_court,
+        u"法官"           : read_judges,
+        u"法官/審裁處成員" : read_judges,
+        u"聆案官"         : read_judges,
+        u"時間"           : read_time,
+        u"案件編號"       : read_cases,
+        u"案件號碼"       : read_cases,
+        u"案件號碼/."     : read_cases,
+        u"訴訟各方"       : read_parties,
+        u"被告/答辯人/"   : read_parties_def,
+        u"性質"           : read_tags,
+        u"控罪/性質"      : read_tags,
+        u"控罪/性質/"     : read_tags,
+        u"聆訊"           : read_tags,
+        u"應訊代表"       : read_lawyers,
+        ""                : skip_column,
+    }
+
+    def compile_plan(header_map):
+        """
+        header_map[cellIdx] = the header for that cell
+        returns (header_map, caseColIdx, handlers), handlers[cellIdx] = column handler for that cell
+        """
+        caseColIdx = 0
+        for idx,h in enumerate(header_map):
+            if u"案件編號" in h or u"案件號碼" in h:
+                caseColIdx = idx
+                break        
+        handlers = [column_handlers.get(h) or unknown_column(h) for h in header_map]
+        return header_map, caseColIdx, handlers
+
     def find_header():
         nonlocal it
         nonlocal ir
         nonlocal headers
+        nonlocal plans
         nonlocal rowsRead
 
-        row = tables[it][ir]
+        row = table[ir]
 
         found = False
         for idx,cell in enumerate(row):
-            tmp = cell.get_text().strip()
+            tmp = cellText(cell)
             if u"案件編號" in tmp or u"案件號碼" in tmp:
                 found = True
                 break        
@@ -423,10 +818,36 @@ def parse(cat, date, text, hide_parties=True):
          
         headers = []
         for cell in row:
-            headers.append( rmAllSpace( rmEn( cell.get_text() )))
+            headers.append( rmAllSpace( rmEn( cellText(cell) )))
         if debug: print(headers)
+
+        # the plans of the rows below, by no. of cells in the row
+        plans = {}
+        #simple 1 to 1 map
+        plans[len(headers)] = compile_plan(headers)
+        #probably some colspan=2 appeared at the header
+        dedupHeaders = rmNeighborDupElems(headers)
+        if len(dedupHeaders) not in plans: plans[len(dedupHeaders)] = compile_plan(dedupHeaders)
+
         rowsRead = 0 #reset no. of rows read
         return 1 
+
+    def row_plan(row):
+        """
+        the compiled plan mapping the cells of row to the headers
+        """
+        if len(row) in plans: return plans[len(row)]
+
+        header_map = [] 
+        if len(rmNeighborDupElems(row, doc.same))==len(headers):
+            #probably some colspan=2 appeared at the row
+            tmp=-1 
+            for i in range(0, len(row)):
+                if i==0 or not doc.same(row[i], row[i-1]): tmp+=1
+                header_map.append( headers[tmp] )
+        key = tuple(header_map)
+        if key not in rowPlans: rowPlans[key] = compile_plan(header_map)
+        return rowPlans[key]
     
     def read_row():
         nonlocal it
@@ -441,49 +862,32 @@ def parse(cat, date, text, hide_parties=True):
         nonlocal judges
         local_court  = None
         local_time   = None
-        local_judges = []
-
-        cases = []
-        parties = []
-        parties_atk = []
-        parties_def = []
-        tags = []
-        lawyers = []
+
+        fields = {
+            "judges"      : [],
+            "cases"       : [],
+            "parties"     : [],
+            "parties_atk" : [],
+            "parties_def" : [],
+            "tags"        : [],
+            "lawyers"     : [],
+        }
         lawyers_atk = []
         lawyers_def = []
 
-        row = tables[it][ir]
+        row = table[ir]
 
         # find the mapping between this row's cell and the header
-        # header_map[cellIdx] = the header for that cell
-        header_map = [] 
-        if len(row)==len(headers):
-            #simple 1 to 1 map
-            header_map = headers
-        elif len(row)==len(rmNeighborDupElems(headers)):
-            #probably some colspan=2 appeared at the header
-            header_map = rmNeighborDupElems(headers)
-        elif len(rmNeighborDupElems(row))==len(headers):
-            #probably some colspan=2 appeared at the row
-            tmp=-1 
-            for i in range(0, len(row)):
-                if i==0 or row[i]!=row[i-1]: tmp+=1
-                header_map.append( headers[tmp] )
+        header_map, caseColIdx, handlers = row_plan(row)
 
         if debug:
             print ("len", len(headers), len(row))
             print ("hm", header_map)
-        
-        caseColIdx = 0
-        for idx,h in enumerate(header_map):
-            if u"案件編號" in h or u"案件號碼" in h:
-                caseColIdx = idx
-                break        
 
         #check if row valid, valid row should have caseNo like: XXXX 1234/2017
         cell = row[caseColIdx]
-        cell = cell.get_text().strip()
-        caseNos = re.findall("(?P<caseNo>[A-Z]{2,4}[\s]*[0-9]*/[0-9]{4})", cell)
+        cell = cellText(cell)
+        caseNos = RE_CASENO.findall(cell)
         if not caseNos and ((u"首次約見" in cell)  or (u"特别程序表" in cell )): caseNos = ["FCMC0000/0000"] # hack for FMC
         if debug: print (it,ir, caseNos, cell)
         if not caseNos: 
@@ -497,155 +901,39 @@ def parse(cat, date, text, hide_parties=True):
         # or a all empty row
         end_ir = ir+1
         for end_ir in range(ir+1, nr):
-            row = tables[it][end_ir]
+            row = table[end_ir]
             cell = row[caseColIdx]
-            cell = cell.get_text().strip()
+            cell = cellText(cell)
             if len(cell)>0: 
-                caseNosNext = re.findall("(?P<caseNo>[A-Z]{2,4}[\s]*[0-9]*/[0-9]{4})", cell)
+                caseNosNext = RE_CASENO.findall(cell)
                 if debug: print("caseNos/next", caseNos, caseNosNext, caseNosNext!=caseNos)
                 if caseNosNext!= caseNos: break
-            if all([ cell.get_text().strip()=="" for cell in row]): break
+            if all([ cellText(cell)=="" for cell in row]): break
             if end_ir+1==nr: end_ir=nr # ugly...  
             
         if debug: print("ir endir nr", ir, end_ir, nr)
 
         for ir in range(ir,end_ir):
-            row = tables[it][ir]
+            row = table[ir]
             for idx,cell in enumerate(row):    
-                header = header_map[idx]
-                s = cell.get_text().strip() 
+                handler = handlers[idx]
+                s = cellText(cell) 
                 if s=="": continue
                 if s=="─": continue
                 if s.strip("_")=="": continue
-                # if debug: print (ir, header)
-
-                if header==u"法庭":
-                    match = []
-                    if not match: match = ["The Court"] if "The Court" in s else []
-                    if not match: match = ["Court of Final Appeal"] if "Court of Final Appeal" in s else []    
-                    if not match: match = re.findall("Court[\s]*(?P<target>[A-Za-z0-9.\s]+)", s)
-                    if not match: 
-                        showParseErr('Error parsing court: %s'%s)
-                        continue
-                    court = rmAllSpace(match[0])
-
-                elif header==u"法官" or header==u"法官/審裁處成員" or header==u"聆案官":
-                    ps = [rmDupSpace(p.get_text()) for p in cell.find_all("p")]
-                    langPairs = getLangPairs(ps, mergeSameLang=True)
-                    
-                    for pair in langPairs:
-                        name_zh = rmPS(rmAllSpace(pair[0])) if pair[0] else None
-                        name_en = rmPS(rmDupSpace(pair[1])) if pair[1] else None
-                        judge = dm.Judge.get_or_create_zh_or_en(name_zh=name_zh, name_en=name_en)
-                        local_judges.append(judge)
-
-                elif header==u"時間":
-                    match = re.findall("(?P<hh>[0-9]{1,2})[\s]*:[\s]*(?P<mm>[0-9]{1,2})[\s]*(?P<apm>[am|AM|pm|PM]*)",s)
-                    if not match: 
-                        showParseErr('Error parsing time: %s'%s)
-                        continue
-                    hh,mm,apm = match[0]
-                    hh = int(hh)
-                    mm = int(mm)
-                    if 'pm' in apm.lower() and hh<12: hh+=12
-                    time = "%02d%02d"%(hh,mm)
-                
-                elif header==u"案件編號" or header==u"案件號碼" or header==u"案件號碼/.":
-                    caseNos = []
-                    if not caseNos: caseNos = re.findall("(?P<caseNo>[A-Z]{2,4}[\s]*[0-9]*/[0-9]{4})", s)
-                    if not caseNos: caseNos = ["FCMC0000/0000"] if (u"首次約見" in s) or (u"特别程序表" in s ) else []
-                    if not caseNos: 
-                        showParseErr('Error parsing caseNo: %s'%s)
-                        continue
-
-                    caseNos = [rmAllSpace(c) for c in caseNos]
-                    
-                    #chinese desciption of the caseNo, if avaialable
-                    desc = re.findall("(?P<desc>[\u4e00-\u9fff.\s]+)", s)
-                    desc = rmDupSpace(desc[0]) if desc else None
-                    
-                    for caseNo in caseNos:
-                        case = dm.Case.get_or_create(caseNo=caseNo)
-                        if desc and case.description==None: case.description = desc
-                        cases.append(case)
-                
-                elif header==u"訴訟各方":
-                    ps = [rmDupSpace(p.get_text()) for p in cell.find_all("p")]
-                    
-                    splitPos = None
-
-                    # we can separate the parties to atk and def when...
-                    # If just 1 'And' appear
-                    andPos = [i for i,p in enumerate(ps) if (p=="AND" or p=="And")]
-                    if len(andPos)==1 : splitPos = andPos[0] 
-
-                    # If its a Criminal case where atk is gov
-                    if rmAllSpace(ps[0])==u"HKSAR(香港特別行政區)v.": splitPos = 0
-
-                    for i,p in enumerate(ps):
-                        if (p=="AND" or p=="And"): continue
-                        party = rmDupSpace( p.strip("RE:").strip("Re:").strip("v.") )
-                        if splitPos is not None:
-                            if i<=splitPos: 
-                                parties_atk.append(party)
-                            else: 
-                                parties_def.append(party)
-                        else:
-                            parties.append(party)
-                
-                elif header==u"被告/答辯人/":
-                    ps = [rmDupSpace(p.get_text()) for p in cell.find_all("p")]
-                    for p in ps:
-                        party = rmDupSpace(p)
-                        parties_def.append(party)
-
-                elif header==u"性質" or header==u"控罪/性質" or header==u"控罪/性質/" or header==u"聆訊":
-                    ps = cell.find_all("p")
-                    if len(ps)==1:
-                        #sometimes they use <\br> instead of multiple <p> 
-                        ps = ps[0].get_text("\n",True).split("\n") 
-                    else:
-                        ps = [p.get_text() for p in ps]
-                    ps = [rmDupSpace(p) for p in ps]
-                    if debug: print("ps@性質", ps)
-                    langPairs = getLangPairs(ps, mergeSameLang=True)
-                    
-                    for pair in langPairs:
-                        #removes (1) (2) 1. 2. etc. at start and end
-                        tmp1 = "\([0-9]{1,2}\)"
-                        tmp2 = "[0-9]{1,2}\."
-                        pattern = "(^{0}|^{1}|{0}$|{1}$)".format(tmp1,tmp2)
-                        name_zh = rmAllSpace(re.sub(pattern,"", pair[0])) if pair[0] else None
-                        name_en = rmDupSpace(re.sub(pattern,"", pair[1])) if pair[1] else None
-
-                        tag = dm.Tag.get_or_create_zh_or_en(name_zh=name_zh, name_en=name_en)
-                        tags.append(tag)
-
-                elif header==u"應訊代表":
-                    ps = [rmDupSpace(p.get_text()) for p in cell.find_all("p")]
-
-                    #strip away all text after "parties in person"
-                    endPos = [i for i,p in enumerate(ps) if "parties in person" in p.lower()]
-                    if len(endPos)>0 : ps = ps[0:endPos[0]]
-
-                    # if debug: print("ps@應訊代表", ps)
-                    langPairs = getLangPairs(ps)
-                    
-                    for pair in langPairs:
-                        name_zh = pair[0] if pair[0] else None
-                        name_en = pair[1] if pair[1] else None
-                        lawyer = dm.Lawyer.get_or_create_zh_or_en(name_zh=name_zh, name_en=name_en)
-                        lawyers.append(lawyer)
-
-                elif header=="":
-                    pass
-
-                else:
-                    showParseErr("Unknown header: %s" % header)
+                handler(s, cell, fields)
+
+        local_judges = fields["judges"     ]
+        cases        = fields["cases"      ]
+        parties      = fields["parties"    ]
+        parties_atk  = fields["parties_atk"]
+        parties_def  = fields["parties_def"]
+        tags         = fields["tags"       ]
+        lawyers      = fields["lawyers"    ]
 
         # duplicates could occur if colspan=2 in table
         local_judges = rmDupElems(local_judges)
-        cases        = rmDupElems(cases       )
+        cases        = rmDupCases(cases       )
         parties      = rmDupElems(parties     )
         parties_atk  = rmDupElems(parties_atk )
         parties_def  = rmDupElems(parties_def )
@@ -671,38 +959,34 @@ def parse(cat, date, text, hide_parties=True):
             lawyers = []
 
 
-        e = dm.Event()
-        e.category = cat
-        e.court = court
-        e.judges = judges
-        e.datetime = datetime.strptime(date+time, "%Y%m%d%H%M")
-        e.cases = cases
-        e.parties = "/".join(parties)
-        e.parties_atk = "/".join(parties_atk)
-        e.parties_def = "/".join(parties_def)
-        e.tags = tags + getDefaultTags(cat)
-        e.lawyers = lawyers
-        e.lawyers_atk = lawyers_atk
-        e.lawyers_def = lawyers_def
+        parties     = "/".join(parties)
+        parties_atk = "/".join(parties_atk)
+        parties_def = "/".join(parties_def)
+        if hide_parties:
+            if parties    : parties    ="hidden"
+            if parties_atk: parties_atk="hidden"
+            if parties_def: parties_def="hidden"
+
+        e = EventRecord(
+            category    = cat,
+            court       = court,
+            datetime    = datetime.strptime(date+time, "%Y%m%d%H%M"),
+            judges      = judges,
+            cases       = cases,
+            parties     = parties,
+            parties_atk = parties_atk,
+            parties_def = parties_def,
+            tags        = rmDupElems(tags + getDefaultTags(cat)),
+            lawyers     = lawyers,
+            lawyers_atk = lawyers_atk,
+            lawyers_def = lawyers_def,
+        )
 
         if debug: 
             print("=====================")
-            e.fullDesc()
+            for k, v in e._asdict().items(): print("%-11s:"%k, v)
             print("=====================")
 
-        if hide_parties:
-            if e.parties    : e.parties    ="hidden"
-            if e.parties_atk: e.parties_atk="hidden"
-            if e.parties_def: e.parties_def="hidden"
-
-        try:
-            dm.session.add(e)
-            dm.session.commit()
-        except SQLAlchemyError as err:
-            print (err)
-            dm.session.rollback()
-            if debug: raise err
-
         events.append(e)
 
         rowsRead +=1
@@ -714,83 +998,117 @@ def parse(cat, date, text, hide_parties=True):
     #===========================================
     # Main body of def parse(...)
     #===========================================
-    soup = BeautifulSoup( text, 'html.parser')
-    tables = soup.find_all('table')
-
-    def explodeTable(t):
-        extractor = Extractor( t )
-        extractor.parse()
-        return extractor.return_list()
-    tables = [ explodeTable(t) for t in tables]
-
-    transit, state = transit_map[cat.upper()]
+    code = cat.upper()
 
     it = 0           #current table
-    nt = len(tables) #total tables
+    table = None     #rows of the current table
     ir = 0           #current row
     nr = 0           #total rows
 
-    events = []
-
-    while it < nt:
+    events = []      #read but not yet yielded
+    nEvents = 0
+
+    # the tables are parsed and exploded one at a time, the previous one is freed
+    # time spent in each step is added to metrics.py, by court code
+    def exploded_tables():
+        tables = doc.iter_tables(text)
+        while True:
+            t0 = perf_counter()
+            t = next(tables, None)
+            t1 = perf_counter()
+            metrics.add("html", code, t1-t0)
+            if t is None: return
+            table = explodeTable(doc, t)
+            metrics.add("explode", code, perf_counter()-t1)
+            metrics.count("tables", code)
+            yield table
+
+    metrics.count("pages", code)
+    tables = exploded_tables()
+
+    # the tables till the 1st header row tell the layout, thus the state machine
+    read, layoutMetadata, layoutHeaders = read_layout(tables, cellText)
+    layout = select_layout(code, layoutMetadata, layoutHeaders)
+    if info is not None:
+        info["layout"] = layout
+        info["fingerprint"] = layoutRegistry.fingerprint(layoutMetadata, layoutHeaders) if layoutHeaders is not None else None
+    if layout is None:
+        showParseErr("No state machine for the layout of %s %s"%(code, date))
+        return
+    transit, state = LAYOUTS[layout]
+
+    def layout_then_rest():
+        # the tables read by read_layout but the last one could be freed by iter_tables already,
+        # they have no header, so only go through find_metadata* / find_header,
+        # reading nothing but cellText, which read_layout filled for all their cells
+        while read: yield read.pop(0)
+        for table in tables:
+            cellTexts.clear()
+            yield table
+
+    for table in layout_then_rest():
         ir = 0
-        nr = len(tables[it])
+        nr = len(table)
         while ir < nr:
             # print (state, ir , nr)
+            t0 = perf_counter()
             if   state==FIND_METADATA       : ret = find_metadata()
             elif state==FIND_METADATA_MAG   : ret = find_metadata_mag()
             elif state==FIND_METADATA_FMC_SP: ret = find_metadata_fmc_sp()
             elif state==FIND_HEADER         : ret = find_header()
             elif state==READ_ROW            : ret = read_row() #would fill events
+            metrics.add(STATE_NAMES[state], code, perf_counter()-t0)
             state = transit[state][ret]
             ir+=1
+            if events:
+                metrics.count("events", code, len(events))
+                nEvents += len(events)
+                yield from events
+                events.clear()
         it+=1
-    
-    return events
+    # a page with hearings but no event read, its layout could have changed
+    if not nEvents: metrics.count("pages_without_events", code)
 
 if __name__=="__main__":
+    from archive import Archive
+
     print (sys.argv)
     debug = True
     # debug = False
+    archive = Archive()
     if len(sys.argv) == 3:
-        code = sys.argv[1]
+        code = sys.argv[1].upper()
         date = sys.argv[2]
-        filePath = "../data/{code}/{code}_{date}.HTML".format(code=code.upper(), date=date)
-
-        f = open(filePath,'r')
-        text = f.read()
+        text = archive.read(code, date)
+        if text is None:
+            filePath = "../data/{code}/{code}_{date}.HTML".format(code=code, date=date)
+            f = open(filePath,'r')
+            text = f.read()
 
         session = dm.init()
         events = parse(code, date, text)
     
     if len(sys.argv) == 1:
-        from glob import glob
+        # re-parse everything in the archive, import ../data with "python archive.py import ../data" first
+        # reparse.py does the same on all cores
+        import pipeline
+        import parseCache
 
         debug = False
 
         session = dm.init("sqlite:///data_test9.sqlite")
 
-        codes = transit_map.keys()
-        for code in codes:
-            code = code.upper()
-            files = glob("../data/{code}/{code}_*.HTML".format(code=code.upper()))
-            files.sort()
-            # files = files[:1]
-            for filePath in files:
-                print(filePath)
-                dateYMD = re.findall("[0-9]{8}",filePath)[0]
-                f = open(filePath,'r')
-                text = f.read()
-                if len(text)==0: continue
-                if "There is no hearing on this day" in text: continue    
-                
-                events = parse(code, dateYMD, text)
-
-                whiteList = [
-                    "../data/BP/BP_20180912.HTML", #Judge name hidden in title
-                    "../data/FLMAG/FLMAG_20181103.HTML", #really have no cases
-                ]
-                print ("Events parsed from %s : %d"%(filePath, len(events)))
-
-                if not events and filePath not in whiteList and "MAG" not in code: 
-                    showParseErr("No event parsed")
+        whiteList = [
+            ("BP", "20180912"), #Judge name hidden in title
+            ("FLMAG", "20181103"), #really have no cases
+        ]
+        def on_done(code, dateYMD, status, nEvents):
+            if status=="ok" and not nEvents and (code, dateYMD) not in whiteList and "MAG" not in code:
+                showParseErr("No event parsed from %s %s"%(code, dateYMD))
+
+        codes = [code.upper() for code in transit_map.keys()]
+        # pages unchanged since the last re-parse, by the same parser version, are read from parse_cache
+        pipeline.run(pipeline.archive_source(archive, codes), on_done=on_done, batchSize=persist.BATCH_SIZE,
+                     cacheDir=parseCache.CACHE_DIR)
+        print (metrics.summary())
+        metrics.write()
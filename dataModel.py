@@ -1,6 +1,9 @@
+import os
 import sqlalchemy
+from collections import OrderedDict
 
 from sqlalchemy import create_engine
+from sqlalchemy import event
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 Base = declarative_base()
@@ -10,18 +13,240 @@ from sqlalchemy import ForeignKey
 from sqlalchemy.orm import relationship
 
 from sqlalchemy import Table
+from sqlalchemy import Index
 
 global session
 session = None
 global Session
 Session = None
-def init(sqlPath='sqlite:///:memory:', echo=False):
+def sqlite_savepoints(engine):
+    """
+    pysqlite begins transactions on its own and not before a SAVEPOINT,
+    let SQLAlchemy emit BEGIN instead so session.begin_nested() works.
+    See https://docs.sqlalchemy.org/en/latest/dialects/sqlite.html#serializable-isolation-savepoints-transactional-ddl
+    """
+    @event.listens_for(engine, "connect")
+    def do_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, "begin")
+    def do_begin(conn):
+        conn.execute("BEGIN")
+
+# SQLite settings per workload, PRAGMAs run on each new connection, in order
+# the engine of a sqlite file opens a connection per transaction and closes it after,
+# so the WAL is checkpointed back into the file as each transaction ends
+PROFILES = {
+    # sqlite's own: rollback journal, synchronous FULL, 2MB page cache, a writer blocks the readers
+    "default": [],
+    # a fresh DB written by a single process, e.g. reparse.py --bulk, no fsync at all:
+    # a crash can corrupt it, the import is then run again
+    "bulk_import": [
+        ("journal_mode", "WAL"),
+        ("synchronous" , "OFF"),
+        ("cache_size"  , -262144),    # KB, 256MB
+        ("mmap_size"   , 1 << 30),
+        ("temp_store"  , "MEMORY"),
+        ("busy_timeout", 5000),       # ms
+    ],
+    # scraper.py writing data.sqlite while dashboard.py reads it, with WAL the readers are not blocked
+    # by a write, NORMAL can lose the last commits on a power loss but does not corrupt the DB
+    "daily_scrape": [
+        ("journal_mode", "WAL"),
+        ("synchronous" , "NORMAL"),
+        ("cache_size"  , -65536),
+        ("mmap_size"   , 256 << 20),
+        ("temp_store"  , "MEMORY"),
+        ("busy_timeout", 30000),
+    ],
+    # dashboard.py, never writes, the journal mode is the one the writer left in the file
+    "dashboard": [
+        ("query_only"  , "ON"),
+        ("cache_size"  , -65536),
+        ("mmap_size"   , 256 << 20),
+        ("temp_store"  , "MEMORY"),
+        ("busy_timeout", 5000),
+    ],
+}
+# overrides the profile given to init, e.g. COURT_DB_PROFILE=bulk_import python scraper.py backfill ...
+DB_PROFILE = os.environ.get("COURT_DB_PROFILE")
+
+def sqlite_profile(engine, name):
+    """
+    run the PRAGMAs of PROFILES[name] on every connection of engine
+    returns them
+    """
+    if name not in PROFILES:
+        raise ValueError("Unknown DB profile: %s, choose from %s" % (name, sorted(PROFILES)))
+    pragmas = PROFILES[name]
+    if not pragmas: return pragmas
+
+    @event.listens_for(engine, "connect")
+    def do_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma, value in pragmas:
+            cursor.execute("PRAGMA %s = %s" % (pragma, value))
+        cursor.close()
+    return pragmas
+
+# Cases kept by the identity cache, the least recently used are dropped beyond this
+MAX_CACHED_CASES = 100000
+
+class IdentityCache(object):
+    """
+    session scoped cache of the Judge / Lawyer / Tag by name_zh and name_en, and the Case by caseNo,
+    so get_or_create* is a dict lookup instead of a SELECT per call
+
+    The Judge / Lawyer / Tag are all loaded, one query per table, on first use,
+    then kept up to date by get_or_create*. A name maps to all instances having it,
+    sorted by id, the 1st one is what query(...).filter_by(name=...).first() gives.
+    Only the MAX_CACHED_CASES last used Cases are kept.
+
+    Only hits are trusted, a name or Case not in the cache is still queried,
+    another process (e.g. a refresh run during a backfill) may have added it since.
+    Any rollback could undo what is cached, the cache is then emptied and reloaded on next use.
+    The session does not expire the cached instances on commit, they would
+    each cost a SELECT to refresh in the next transaction.
+    """
+    def __init__(self, session, maxCases=MAX_CACHED_CASES):
+        self.session = session
+        self.maxCases = maxCases
+        self.names = {}              # cls -> {"name_zh": {name: [instance, ...]}, "name_en": {...}}
+        self.cases = OrderedDict()   # caseNo -> Case, least recently used first
+        session.expire_on_commit = False
+        event.listen(session, "after_soft_rollback", lambda session, previous_transaction: self.clear())
+
+    def clear(self):
+        self.names.clear()
+        self.cases.clear()
+
+    def _index(self, cls):
+        if cls not in self.names:
+            self.names[cls] = {"name_zh": {}, "name_en": {}}
+            for instance in self.session.query(cls).order_by(cls.id):
+                self.add(instance)
+        return self.names[cls]
+
+    def first(self, cls, attr, name):
+        """
+        the 1st instance of cls, by id, with attr == name, None if there is none
+        """
+        byName = self._index(cls)[attr]
+        instances = byName.get(name)
+        if instances: return instances[0]
+        instance = self.session.query(cls).filter_by(**{attr: name}).order_by(cls.id).first()
+        if instance is not None: self._insert(byName, name, instance)
+        return instance
+
+    def add(self, instance):
+        index = self._index(type(instance))
+        for attr in ("name_zh", "name_en"):
+            self._insert(index[attr], getattr(instance, attr), instance)
+
+    def renamed(self, instance, attr, old):
+        index = self._index(type(instance))[attr]
+        if old in index:
+            index[old].remove(instance)
+            if not index[old]: del index[old]
+        self._insert(index, getattr(instance, attr), instance)
+
+    def _insert(self, byName, name, instance):
+        if name is None: return
+        instances = byName.setdefault(name, [])
+        instances.append(instance)
+        if len(instances) > 1: instances.sort(key=lambda x: x.id)
+
+    def get_case(self, caseNo):
+        case = self.cases.get(caseNo)
+        if case is not None: self.cases.move_to_end(caseNo)
+        return case
+
+    def add_case(self, case):
+        self.cases[case.caseNo] = case
+        if len(self.cases) > self.maxCases: self.cases.popitem(last=False)
+
+def get_identity_cache():
+    """
+    the IdentityCache of session, None if it has none
+    """
+    return session.info.get("identity_cache") if session else None
+
+# Schema versions, kept in PRAGMA user_version of the sqlite file
+# a new DB gets the schema of the model at once, an older file is brought up to date by
+# running the migrations after its version, in order, see migrate
+# When changing the model, add the statements doing the same to an existing DB here
+# No ANALYZE, the stats of a small DB would keep the planner scanning the tables as they grow
+MIGRATIONS = [
+    (1, "indexes on the name lookups, the event filters and the association tables", [
+        "CREATE INDEX IF NOT EXISTS ix_judges_name_zh  ON judges (name_zh)",
+        "CREATE INDEX IF NOT EXISTS ix_judges_name_en  ON judges (name_en)",
+        "CREATE INDEX IF NOT EXISTS ix_lawyers_name_zh ON lawyers (name_zh)",
+        "CREATE INDEX IF NOT EXISTS ix_lawyers_name_en ON lawyers (name_en)",
+        "CREATE INDEX IF NOT EXISTS ix_tags_name_zh    ON tags (name_zh)",
+        "CREATE INDEX IF NOT EXISTS ix_tags_name_en    ON tags (name_en)",
+        "CREATE INDEX IF NOT EXISTS ix_events_category_datetime ON events (category, datetime)",
+        "CREATE INDEX IF NOT EXISTS ix_events_datetime ON events (datetime)",
+        "CREATE INDEX IF NOT EXISTS ix_events_court    ON events (court)",
+        "CREATE INDEX IF NOT EXISTS ix_events_judges_judge_id   ON events_judges (judge_id, event_id)",
+        "CREATE INDEX IF NOT EXISTS ix_events_cases_case_id     ON events_cases (case_id, event_id)",
+        "CREATE INDEX IF NOT EXISTS ix_events_tags_tag_id       ON events_tags (tag_id, event_id)",
+        "CREATE INDEX IF NOT EXISTS ix_events_lawyers_lawyer_id ON events_lawyers (lawyer_id, event_id)",
+        "CREATE INDEX IF NOT EXISTS ix_events_lawyers_atk_lawyer_id ON events_lawyers_atk (lawyer_id, event_id)",
+        "CREATE INDEX IF NOT EXISTS ix_events_lawyers_def_lawyer_id ON events_lawyers_def (lawyer_id, event_id)",
+    ]),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").scalar()
+
+def migrate(engine):
+    """
+    run the MIGRATIONS an existing sqlite DB has not had yet, each in its own transaction
+    returns the list of versions applied
+    """
+    applied = []
+    with engine.connect() as conn:
+        for version, desc, statements in MIGRATIONS:
+            if version <= schema_version(conn): continue
+            print ("Migrating %s to schema version %d: %s"%(engine.url, version, desc))
+            trans = conn.begin()
+            for sql in statements:
+                conn.execute(sql)
+            conn.execute("PRAGMA user_version = %d"%version)
+            trans.commit()
+            applied.append(version)
+    return applied
+
+def init(sqlPath='sqlite:///:memory:', echo=False, identity_cache=True, profile=None):
+    """
+    creates the tables if needed, and migrates an sqlite DB of an older schema, see MIGRATIONS
+    identity_cache: give the session an IdentityCache for get_or_create*, see IdentityCache
+    profile: one of PROFILES for an sqlite DB, "default" if None, the COURT_DB_PROFILE env var overrides it
+             a read only profile ("query_only") leaves the schema alone
+    """
     engine = create_engine(sqlPath, echo=echo)
-    Base.metadata.create_all(engine)
+    readOnly = False
+    if engine.dialect.name == "sqlite":
+        sqlite_savepoints(engine)
+        readOnly = ("query_only", "ON") in sqlite_profile(engine, DB_PROFILE or profile or "default")
+    if readOnly:
+        with engine.connect() as conn:
+            if schema_version(conn) < SCHEMA_VERSION:
+                print ("%s is of schema version %d, not migrated to %d by a read only profile"%(engine.url, schema_version(conn), SCHEMA_VERSION))
+    else:
+        isNew = not engine.has_table(Event.__tablename__)
+        Base.metadata.create_all(engine)
+        if engine.dialect.name == "sqlite":
+            if isNew:
+                with engine.connect() as conn: conn.execute("PRAGMA user_version = %d"%SCHEMA_VERSION)
+            else:
+                migrate(engine)
     global Session
     Session = sessionmaker(bind=engine)
     global session
     session = Session()
+    if identity_cache: session.info["identity_cache"] = IdentityCache(session)
     return session
 
 def get_session():
@@ -32,11 +257,18 @@ def get_or_create(cls, **kwargs):
         print('db not init/connected yet')
         return None
 
+    cache = get_identity_cache()
+    if cache and cls is Case and list(kwargs) == ["caseNo"]:
+        instance = cache.get_case(kwargs["caseNo"])
+        if instance is not None: return instance
+
     instance = session.query(cls).filter_by(**kwargs).first()
     if not instance:
         instance = cls(**kwargs)
         session.add(instance)
         session.flush([instance])
+        if cache and cls in (Judge, Lawyer, Tag): cache.add(instance)
+    if cache and cls is Case: cache.add_case(instance)
     return instance
 
 def get_or_create_zh_or_en(cls, name_zh, name_en, shorten_names = False):
@@ -44,67 +276,87 @@ def get_or_create_zh_or_en(cls, name_zh, name_en, shorten_names = False):
         print('db not init/connected yet')
         return None
 
+    cache = get_identity_cache()
+    def first(attr, name):
+        if cache: return cache.first(cls, attr, name)
+        return session.query(cls).filter_by(**{attr: name}).first()
+
+    def rename(instance, attr, name):
+        old = getattr(instance, attr)
+        setattr(instance, attr, name)
+        session.add(instance)
+        session.flush([instance])
+        if cache: cache.renamed(instance, attr, old)
+
     if name_zh:
-        instance = session.query(cls).filter_by(name_zh=name_zh).first()
+        instance = first("name_zh", name_zh)
         if instance:
             if name_en:
                 if (not instance.name_en) or (shorten_names and (2<len(name_en)<len(instance.name_en))):
-                    instance.name_en=name_en
-                    session.add(instance)
-                    session.flush([instance])
+                    rename(instance, "name_en", name_en)
             return instance
 
     if name_en:
-        instance = session.query(cls).filter_by(name_en=name_en).first()
+        instance = first("name_en", name_en)
         if instance:
             if name_zh:
                 if (not instance.name_zh) or (shorten_names and (1<len(name_zh)<len(instance.name_zh))):
-                    instance.name_zh=name_zh
-                    session.add(instance)
-                    session.flush([instance])
+                    rename(instance, "name_zh", name_zh)
             return instance
 
     instance = cls(name_zh=name_zh, name_en=name_en)
     session.add(instance)
     session.flush([instance])
+    if cache: cache.add(instance)
     return instance
 
 # association table for many to many relationships
+# the primary key gives the judges etc. of an event, the index on the other column the events of a judge etc.
 events_judges = Table('events_judges', Base.metadata,
     Column('event_id', ForeignKey('events.id'), primary_key=True),
-    Column('judge_id', ForeignKey('judges.id'), primary_key=True)
+    Column('judge_id', ForeignKey('judges.id'), primary_key=True),
+    Index('ix_events_judges_judge_id', 'judge_id', 'event_id'),
 )
 
 events_cases = Table('events_cases', Base.metadata,
     Column('event_id', ForeignKey('events.id'), primary_key=True),
-    Column('case_id', ForeignKey('cases.id'), primary_key=True)
+    Column('case_id', ForeignKey('cases.id'), primary_key=True),
+    Index('ix_events_cases_case_id', 'case_id', 'event_id'),
 )
 
 events_tags = Table('events_tags', Base.metadata,
     Column('event_id', ForeignKey('events.id'), primary_key=True),
-    Column('tag_id', ForeignKey('tags.id'), primary_key=True)
+    Column('tag_id', ForeignKey('tags.id'), primary_key=True),
+    Index('ix_events_tags_tag_id', 'tag_id', 'event_id'),
 )
 
 events_lawyers = Table('events_lawyers', Base.metadata,
     Column('event_id', ForeignKey('events.id'), primary_key=True),
-    Column('lawyer_id', ForeignKey('lawyers.id'), primary_key=True)
+    Column('lawyer_id', ForeignKey('lawyers.id'), primary_key=True),
+    Index('ix_events_lawyers_lawyer_id', 'lawyer_id', 'event_id'),
 )
 
 events_lawyers_atk = Table('events_lawyers_atk', Base.metadata,
     Column('event_id', ForeignKey('events.id'), primary_key=True),
-    Column('lawyer_id', ForeignKey('lawyers.id'), primary_key=True)
+    Column('lawyer_id', ForeignKey('lawyers.id'), primary_key=True),
+    Index('ix_events_lawyers_atk_lawyer_id', 'lawyer_id', 'event_id'),
 )
 
 events_lawyers_def = Table('events_lawyers_def', Base.metadata,
     Column('event_id', ForeignKey('events.id'), primary_key=True),
-    Column('lawyer_id', ForeignKey('lawyers.id'), primary_key=True)
+    Column('lawyer_id', ForeignKey('lawyers.id'), primary_key=True),
+    Index('ix_events_lawyers_def_lawyer_id', 'lawyer_id', 'event_id'),
 )
 
 class Event(Base):
     __tablename__ = 'events'
+    __table_args__ = (
+        # the events of a court list on a day, also serves category alone
+        Index('ix_events_category_datetime', 'category', 'datetime'),
+    )
     id = Column(Integer, primary_key=True)
     category = Column(String)
-    court = Column(String)
+    court = Column(String, index=True)
 
     judges = relationship("Judge", 
                           secondary=events_judges,
@@ -112,7 +364,7 @@ class Event(Base):
                           lazy="dynamic",
                           )
 
-    datetime = Column(DateTime(), nullable=True)
+    datetime = Column(DateTime(), nullable=True, index=True)
 
     #sometimes a event can have 2 cases
     cases = relationship("Case", 
@@ -174,8 +426,8 @@ class Event(Base):
 class Judge(Base):
     __tablename__ = 'judges'
     id = Column(Integer, primary_key=True)
-    name_zh = Column(String, unique=False)
-    name_en = Column(String, unique=False)
+    name_zh = Column(String, unique=False, index=True)
+    name_en = Column(String, unique=False, index=True)
 
     events = relationship("Event", 
                           secondary=events_judges,
@@ -220,8 +472,8 @@ class Tag(Base):
     """
     __tablename__ = 'tags'
     id = Column(Integer, primary_key=True)
-    name_zh = Column(String, unique=False)
-    name_en = Column(String, unique=False)
+    name_zh = Column(String, unique=False, index=True)
+    name_en = Column(String, unique=False, index=True)
 
     events = relationship("Event", 
                           secondary=events_tags,
@@ -244,8 +496,8 @@ class Tag(Base):
 class Lawyer(Base):
     __tablename__ = 'lawyers'
     id = Column(Integer, primary_key=True)
-    name_zh = Column(String, unique=False) # '孖士打律師行' = 'Mayer Brown' also 'Mayer Brown JSM'...
-    name_en = Column(String, unique=False)
+    name_zh = Column(String, unique=False, index=True) # '孖士打律師行' = 'Mayer Brown' also 'Mayer Brown JSM'...
+    name_en = Column(String, unique=False, index=True)
     
     events = relationship("Event", 
                           secondary=events_lawyers,
@@ -3,8 +3,10 @@
 # this is from
 # https://github.com/yuanxu-li/html-table-extractor/blob/master/html_table_extractor/extractor.py
 # changed to reutrn raw html dom of each cell instead of text
+# and to explode the table into a pre-sized grid in 2 passes
 
 from bs4 import BeautifulSoup, Tag
+from lxml import etree
 import os
 import csv
 import pdb
@@ -15,16 +17,26 @@ class Extractor(object):
         # to deal with string and bs4.Tag separately
 
         # validate the input
-        if not isinstance(input, str) and not isinstance(input, Tag):
-            raise Exception('Unrecognized type. Valid input: str, bs4.element.Tag')
-
-        soup = BeautifulSoup(input, 'html.parser').find() if isinstance(input, str) else input
-
-        # locate the target table
-        if soup.name == 'table':
-            self._table = soup
+        if not isinstance(input, str) and not isinstance(input, Tag) and not isinstance(input, etree._Element):
+            raise Exception('Unrecognized type. Valid input: str, bs4.element.Tag, lxml element')
+
+        if isinstance(input, etree._Element):
+            # lxml element, e.g. from htmlBackend.LxmlBackend
+            self._lxml = True
+            if input.tag == 'table':
+                self._table = input
+            else:
+                found = input.xpath('.//*[@id=$id]', id=id_)
+                self._table = found[0] if found else None
         else:
-            self._table = soup.find(id=id_)
+            self._lxml = False
+            soup = BeautifulSoup(input, 'html.parser').find() if isinstance(input, str) else input
+
+            # locate the target table
+            if soup.name == 'table':
+                self._table = soup
+            else:
+                self._table = soup.find(id=id_)
 
         if 'transformer' in kwargs:
             self._transformer = kwargs['transformer']
@@ -33,48 +45,83 @@ class Extractor(object):
 
         self._output = []
 
-    def parse(self):
+    def parse(self, skip=None):
+        """
+        explode the table into a grid, self._output[i][j] = the cell at row i col j
+        a cell with rowspan / colspan is put at every position it covers
+        skip(table) -> True leaves the table out, self._output is then []
+        """
         self._output = []
+        if skip is not None and skip(self._table):
+            return self
+
+        # 1st pass: the cells of each row and the row index it starts at,
+        # so the grid can be sized before filling it
+        rows = []
         row_ind = 0
-        col_ind = 0
-        for row in self._table.find_all('tr'):
+        height = 0
+        width = 0
+        spanned = {} # spanned[i] = no. of cols of row i taken by rowspan cells from the rows above
+        for row in (self._table.iter('tr') if self._lxml else self._table.find_all('tr')):
             # record the smallest row_span, so that we know how many rows
             # we should skip
             smallest_row_span = 1
-
-            for cell in row.children:
-                if cell.name in ('td', 'th'):
-                    # check multiple rows
-                    # pdb.set_trace()
-                    row_span = int(cell.get('rowspan')) if cell.get('rowspan') else 1
-
-                    # try updating smallest_row_span
-                    smallest_row_span = min(smallest_row_span, row_span)
-
-                    # check multiple columns
-                    col_span = int(cell.get('colspan')) if cell.get('colspan') else 1
-
-                    # find the right index
-                    while True:
-                        if self._check_cell_validity(row_ind, col_ind):
-                            break
-                        col_ind += 1
-
-                    # insert into self._output
-                    try:
-                        # self._insert(row_ind, col_ind, row_span, col_span, self._transformer(cell.get_text()))
-                        self._insert(row_ind, col_ind, row_span, col_span, cell)
-                    except UnicodeEncodeError:
-                        raise Exception( 'Failed to decode text; you might want to specify kwargs transformer=unicode' )
-
-                    # update col_ind
-                    col_ind += col_span
-
-            # update row_ind
+            largest_row_span = 1
+            row_width = spanned.get(row_ind, 0)
+            cells = []
+            for cell in row:
+                if self._cell_name(cell) in ('td', 'th'):
+                    row_span = cell.get('rowspan')
+                    row_span = int(row_span) if row_span else 1
+                    col_span = cell.get('colspan')
+                    col_span = int(col_span) if col_span else 1
+                    cells.append( (cell, row_span, col_span) )
+                    row_width += max(col_span, 0)
+                    if row_span != 1:
+                        smallest_row_span = min(smallest_row_span, row_span)
+                        largest_row_span  = max(largest_row_span , row_span)
+                        for ii in range(row_ind+1, row_ind+row_span):
+                            spanned[ii] = spanned.get(ii, 0) + col_span
+            if cells: height = max(height, row_ind + largest_row_span)
+            rows.append( (row_ind, cells) )
+            width = max(width, row_width)
             row_ind += smallest_row_span
+        if spanned: width = max(width, max(spanned.values()))
+
+        # 2nd pass: place each cell at the 1st free col of its row and fill its span
+        grid = [[None]*width for _ in range(height)]
+        for row_ind, cells in rows:
+            line = grid[row_ind] if cells else None
             col_ind = 0
+            for cell, row_span, col_span in cells:
+                # find the right index
+                while col_ind < len(line) and line[col_ind] is not None:
+                    col_ind += 1
+                if row_span == 1 and col_span == 1 and col_ind < len(line):
+                    line[col_ind] = cell
+                else:
+                    for ii in range(row_ind, row_ind+row_span):
+                        spanLine = grid[ii]
+                        if col_ind+col_span > len(spanLine):
+                            spanLine.extend( [None]*(col_ind+col_span-len(spanLine)) )
+                        for jj in range(col_ind, col_ind+col_span):
+                            if spanLine[jj] is None: spanLine[jj] = cell
+                col_ind += col_span
+
+        # rows end at their last cell, like the table is written
+        for line in grid:
+            n = len(line)
+            while n and line[n-1] is None: n -= 1
+            del line[n:]
+        while grid and not grid[-1]: grid.pop()
+        self._output = grid
         return self
 
+    def _cell_name(self, cell):
+        if self._lxml:
+            return cell.tag # not a str for comments
+        return cell.name
+
     def return_list(self):
         return self._output
 
@@ -84,36 +131,3 @@ class Extractor(object):
             for row in self._output:
                 table_writer.writerow(row)
         return
-
-    def _check_validity(self, i, j, height, width):
-        """
-        check if a rectangle (i, j, height, width) can be put into self.output
-        """
-        return all(self._check_cell_validity(ii, jj) for ii in range(i, i+height) for jj in range(j, j+width))
-
-    def _check_cell_validity(self, i, j):
-        """
-        check if a cell (i, j) can be put into self._output
-        """
-        if i >= len(self._output):
-            return True
-        if j >= len(self._output[i]):
-            return True
-        if self._output[i][j] is None:
-            return True
-        return False
-
-    def _insert(self, i, j, height, width, val):
-        # pdb.set_trace()
-        for ii in range(i, i+height):
-            for jj in range(j, j+width):
-                self._insert_cell(ii, jj, val)
-
-    def _insert_cell(self, i, j, val):
-        while i >= len(self._output):
-            self._output.append([])
-        while j >= len(self._output[i]):
-            self._output[i].append(None)
-
-        if self._output[i][j] is None:
-            self._output[i][j] = val
\ No newline at end of file
@@ -0,0 +1,338 @@
+"""
+Concurrent fetcher for the court list pages
+
+The blocking requests calls are run in a thread pool driven by asyncio,
+all sharing one requests.Session so the keep-alive connections
+to the judiciary server are reused between pages.
+
+Usage:
+    def on_page(code, dateYMD, text):
+        ...
+    latencies = fetcher.run(jobs, on_page, concurrency=8)
+
+jobs is a list of (code, dateObj)
+on_page is called in the caller's thread as soon as each page arrives
+
+If an archive.Archive is given, every page fetched is stored in it and
+re-fetches are conditional (If-None-Match / If-Modified-Since).
+Pages with the same content as the last one saved to the DB
+(Archive.mark_persisted, by pipeline.run) are then not passed to on_page,
+unless skip_unchanged=False.
+
+Pages are streamed, the download is aborted as soon as the page is known
+to have no hearing or to not be a court list. Pages with no hearing are
+passed to on_page as "", pages not a court list are treated as a failed
+fetch. With an archive, both are put in its negative cache so they are
+not requested again.
+
+The no. of requests in flight is adjusted by a RateController:
+it backs off when the server gets slow or returns errors, and slowly
+ramps up again while it is healthy. Failed requests are retried
+with jittered exponential backoff, as are requests timing out (TIMEOUT).
+"""
+import asyncio
+import random
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.compat import chardet
+
+from archive import NO_HEARING, NOT_LIST
+
+BASE_URL = "https://e-services.judiciary.hk/dcl/view.jsp"
+
+ua = "Mozilla/5.0 (Windows NT 6.1; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/69.0.3497.100 Safari/537.36"
+header = {
+    'User-Agent': ua
+}
+
+DEFAULT_CONCURRENCY = 8
+
+MAX_RETRIES   = 4
+BACKOFF_BASE  = 1.0  # sec
+BACKOFF_CAP   = 60.0 # sec
+RETRY_STATUS  = (429, 500, 502, 503, 504)
+# (connect, read) sec, a stalled connection fails and is retried instead of holding its slot forever
+TIMEOUT       = (10.0, 30.0)
+
+CHUNK_SIZE = 8192
+NO_HEARING_MARKER = b"There is no hearing on this day"
+# a court list has its tables well within the first HEAD_SIZE bytes
+HEAD_SIZE = 65536
+
+class ServerBusy(requests.RequestException):
+    """
+    the server answered with a status worth retrying, e.g. 503
+    """
+    def __init__(self, status, retryAfter=None):
+        super().__init__("HTTP %d"%status)
+        self.status = status
+        self.retryAfter = retryAfter
+
+class RateController(object):
+    """
+    Adaptive limit on the no. of requests in flight (AIMD)
+
+    The limit grows by ~1 per round of successful requests and is halved
+    when a request fails or is much slower than the median of recent ones,
+    at most once per cooldown (~1 round trip) so a burst of failures only counts once.
+
+    Lives in the event loop thread, acquire() / release() are not thread safe.
+    """
+    def __init__(self, maxConcurrency=DEFAULT_CONCURRENCY, minConcurrency=1,
+                 slowFactor=3.0, window=50, cooldown=None):
+        self.maxConcurrency = maxConcurrency
+        self.minConcurrency = minConcurrency
+        self.slowFactor = slowFactor # slow if latency > slowFactor * median latency in window
+        self.cooldown = cooldown     # sec between 2 decreases, default is the median latency
+        self.limit = float(maxConcurrency)
+        self.inflight = 0
+        self._cond = None
+        self._latencies = deque(maxlen=window)
+        self._outcomes  = deque(maxlen=window) # True for error
+        self._doneAt    = deque(maxlen=window) # time of completion
+        self._lastDecrease = 0.0
+
+    async def acquire(self):
+        if self._cond is None: self._cond = asyncio.Condition()
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.inflight < int(self.limit))
+            self.inflight += 1
+
+    async def release(self, latency=None, error=False):
+        """
+        latency of the request just done, or error=True if it failed
+        """
+        now = time.monotonic()
+        self._outcomes.append(error)
+        self._doneAt.append(now)
+
+        slow = False
+        if not error:
+            if len(self._latencies) >= 5:
+                slow = latency > self.slowFactor * self.median_latency()
+            self._latencies.append(latency)
+
+        if error or slow:
+            cooldown = self.cooldown or self.median_latency() or 1.0
+            if now - self._lastDecrease > cooldown:
+                self.limit = max(self.minConcurrency, self.limit / 2)
+                self._lastDecrease = now
+        else:
+            self.limit = min(self.maxConcurrency, self.limit + 1.0/self.limit)
+
+        async with self._cond:
+            self.inflight -= 1
+            self._cond.notify_all()
+
+    def rate(self):
+        """
+        completed requests per sec over the window
+        """
+        if len(self._doneAt) < 2: return 0.0
+        span = self._doneAt[-1] - self._doneAt[0]
+        return (len(self._doneAt)-1) / span if span > 0 else 0.0
+
+    def median_latency(self):
+        if not self._latencies: return None
+        return sorted(self._latencies)[len(self._latencies)//2]
+
+    def error_rate(self):
+        if not self._outcomes: return 0.0
+        return sum(self._outcomes) / len(self._outcomes)
+
+    def snapshot(self):
+        return {
+            "limit"     : int(self.limit),
+            "inflight"  : self.inflight,
+            "rate"      : self.rate(),
+            "error_rate": self.error_rate(),
+            "latency"   : self.median_latency(),
+        }
+
+    def __repr__(self):
+        snap = self.snapshot()
+        return "<RateController(limit=%d, inflight=%d, rate=%.2f/s, error_rate=%.2f)>" % (
+                    snap["limit"], snap["inflight"], snap["rate"], snap["error_rate"])
+
+def backoff(attempt, retryAfter=None):
+    """
+    sec to wait before retry no. attempt (0 based), full jitter
+    """
+    if retryAfter is not None: return min(BACKOFF_CAP, retryAfter)
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2**attempt))
+
+def parse_retry_after(value):
+    if value and value.strip().isdigit(): return float(value)
+    return None
+
+def make_url(code, dateObj):
+    dateDMY = datetime.strftime(dateObj, "%d%m%Y") # 01122018
+    return "{}?lang=tc&date={}&court={}".format(BASE_URL, dateDMY, code)
+
+def make_session(concurrency=DEFAULT_CONCURRENCY):
+    """
+    a requests.Session whose connection pool is big enough
+    to keep one connection alive per concurrent fetch
+    """
+    session = requests.Session()
+    session.headers.update(header)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def read_stream(r):
+    """
+    read the body of a streamed response
+    returns (bytes, reason), reason is NO_HEARING or NOT_LIST if aborted early, else None
+    """
+    contentType = r.headers.get("Content-Type", "html")
+    if "html" not in contentType.lower():
+        r.close()
+        return b"", NOT_LIST
+
+    chunks = []
+    size = 0
+    tail = b""
+    seenTable = False
+    for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+        # search across the chunk boundary too
+        window = tail + chunk
+        if NO_HEARING_MARKER in window:
+            r.close()
+            return b"", NO_HEARING
+        if not seenTable:
+            seenTable = b"<table" in window.lower()
+        chunks.append(chunk)
+        size += len(chunk)
+        tail = chunk[-len(NO_HEARING_MARKER):]
+        if not seenTable and size > HEAD_SIZE:
+            r.close()
+            return b"", NOT_LIST
+    return b"".join(chunks), None
+
+def decode(r, data):
+    """
+    same as r.text, for a body read by read_stream
+    """
+    encoding = r.encoding or chardet.detect(data)["encoding"] or "utf-8"
+    return str(data, encoding, errors="replace")
+
+def fetch(session, code, dateObj, archive=None):
+    """
+    blocking fetch of one page
+    returns (text, latency in sec, changed, ttfb)
+    text is "" for pages with no hearing, None for pages not a court list
+    changed is False if the events of the same content are already saved, see Archive.mark_persisted
+    ttfb is the time till the response headers arrive, i.e. not depending on the page size
+    """
+    url = make_url(code, dateObj)
+    dateYMD = datetime.strftime(dateObj, "%Y%m%d")
+    extraHeaders = archive.conditional_headers(code, dateYMD) if archive else {}
+
+    t0 = time.perf_counter()
+    r = session.get(url, headers=extraHeaders, stream=True, timeout=TIMEOUT)
+    ttfb = r.elapsed.total_seconds()
+    if r.status_code in RETRY_STATUS:
+        r.close()
+        raise ServerBusy(r.status_code, parse_retry_after(r.headers.get("Retry-After")))
+    if r.status_code == 304:
+        r.close()
+        latency = time.perf_counter() - t0
+        last = archive.latest(code, dateYMD)
+        archive.record(code, dateYMD, last["sha256"], last["etag"], last["last_modified"])
+        return archive.get(last["sha256"]), latency, last["sha256"] != archive.persisted_sha(code, dateYMD), ttfb
+
+    data, reason = read_stream(r)
+    latency = time.perf_counter() - t0
+    if reason:
+        print ("%s %s: %s, aborted"%(code, dateYMD, reason))
+        # a page for today or later could still be filled in
+        if archive and dateObj < datetime.now().date():
+            archive.mark_empty(code, dateYMD, reason)
+        text = "" if reason == NO_HEARING else None
+        return text, latency, True, ttfb
+
+    text = decode(r, data)
+    changed = True
+    if archive:
+        sha, _ = archive.put(code, dateYMD, text,
+                             etag=r.headers.get("ETag"),
+                             last_modified=r.headers.get("Last-Modified"))
+        changed = sha != archive.persisted_sha(code, dateYMD)
+    return text, latency, changed, ttfb
+
+async def fetch_all(jobs, on_page, concurrency=DEFAULT_CONCURRENCY, archive=None, skip_unchanged=True, controller=None):
+    """
+    fetch all (code, dateObj) in jobs, at most concurrency at a time
+    call on_page(code, dateYMD, text) for each page in order of arrival
+    if skip_unchanged, pages with the same content as the last one saved to the DB are not passed to on_page
+    controller is a RateController, one with maxConcurrency=concurrency is made if not given
+    returns list of (code, dateYMD, latency), latency is None if fetch failed
+    """
+    loop = asyncio.get_running_loop()
+    controller = controller or RateController(maxConcurrency=concurrency)
+    concurrency = controller.maxConcurrency
+    session = make_session(concurrency)
+    latencies = []
+
+    async def fetch_job(code, dateObj):
+        reason = archive.empty_reason(code, datetime.strftime(dateObj, "%Y%m%d")) if archive else None
+        if reason:
+            text = "" if reason == NO_HEARING else None
+            return code, dateObj, text, 0.0, True
+
+        for attempt in range(MAX_RETRIES+1):
+            await controller.acquire()
+            try:
+                text, latency, changed, ttfb = await loop.run_in_executor(pool, fetch, session, code, dateObj, archive)
+            except requests.RequestException as e:
+                await controller.release(error=True)
+                if attempt == MAX_RETRIES:
+                    print("Fail fetching %s %s"%(code, dateObj))
+                    print(e)
+                    break
+                wait = backoff(attempt, getattr(e, "retryAfter", None))
+                print("Retry %s %s in %.1fs: %s"%(code, dateObj, wait, e))
+                await asyncio.sleep(wait)
+                continue
+            except Exception as e:
+                # e.g. an archive error, not worth a retry, fail this page and go on with the others
+                await controller.release(error=True)
+                print("Fail fetching %s %s: %r"%(code, dateObj, e))
+                break
+            await controller.release(latency=ttfb)
+            return code, dateObj, text, latency, changed
+        return code, dateObj, None, None, False
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        tasks = [asyncio.ensure_future(fetch_job(code, dateObj)) for code, dateObj in jobs]
+        for task in asyncio.as_completed(tasks):
+            code, dateObj, text, latency, changed = await task
+            dateYMD = datetime.strftime(dateObj, "%Y%m%d")
+            latencies.append( (code, dateYMD, latency) )
+            if len(latencies) % 50 == 0: print (controller)
+            if text is None: continue
+            if skip_unchanged and not changed:
+                print ("Unchanged %s %s, skip parsing"%(code, dateYMD))
+                continue
+            on_page(code, dateYMD, text)
+
+    session.close()
+    print (controller)
+    return latencies
+
+def run(jobs, on_page, concurrency=DEFAULT_CONCURRENCY, archive=None, skip_unchanged=True, controller=None):
+    return asyncio.run(fetch_all(jobs, on_page, concurrency, archive, skip_unchanged, controller))
+
+def print_latencies(latencies):
+    for code, dateYMD, latency in sorted(latencies, key=lambda x: -(x[2] or 0)):
+        if latency is None:
+            print ("Fetched %-6s %s failed"%(code, dateYMD))
+        else:
+            print ("Fetched %-6s %s in %.3fs"%(code, dateYMD, latency))
@@ -0,0 +1,112 @@
+"""
+Html document backends for courtParser
+
+A backend hides which html library the page is parsed with.
+courtParser only touches the page through these methods:
+    tables(text)  : all <table> of the page, in document order
+    iter_tables(text) : the same, one by one, a table is freed once the next one is asked for
+    text(el)      : all text in el, like bs4's el.get_text()
+    ps(el)        : all <p> in el
+    lines(el)     : the stripped non-empty text pieces of el, e.g. split by <br>
+    same(a, b)    : if cells a and b are equal, like bs4's a == b
+                    (cells with colspan / rowspan appear more than once in an exploded table)
+
+"bs4"  : BeautifulSoup with the pure python html.parser, the original one
+"lxml" : lxml.html, a lot faster, gives the same output on the court lists.
+         iter_tables parses incrementally, only the table being read is kept in memory
+"""
+from bs4 import BeautifulSoup
+import lxml.html
+from lxml import etree
+
+# chars fed to the incremental parser at a time
+CHUNK_SIZE = 65536
+
+class Bs4Backend(object):
+    name = "bs4"
+
+    def tables(self, text):
+        soup = BeautifulSoup( text, 'html.parser')
+        return soup.find_all('table')
+
+    def iter_tables(self, text):
+        # html.parser builds the whole soup anyway, free the tables once read
+        for t in self.tables(text):
+            yield t
+            # an outer table comes before the tables in it, keep it for them
+            if t.find("table") is None: t.decompose()
+
+    def text(self, el):
+        return el.get_text()
+
+    def ps(self, el):
+        return el.find_all("p")
+
+    def lines(self, el):
+        return el.get_text("\n",True).split("\n")
+
+    def same(self, a, b):
+        return a == b
+
+class LxmlBackend(object):
+    name = "lxml"
+
+    def tables(self, text):
+        if not text.strip(): return []
+        try:
+            root = lxml.html.document_fromstring(text)
+        except ValueError:
+            # str with a <?xml encoding=...?> declaration
+            root = lxml.html.document_fromstring(text.encode("utf-8"), parser=lxml.html.HTMLParser(encoding="utf-8"))
+        # html.parser does not count <script> / <style> as text, lxml does
+        etree.strip_elements(root, "script", "style", with_tail=False)
+        return root.findall(".//table")
+
+    def iter_tables(self, text):
+        if not text.strip(): return
+        parser = etree.HTMLPullParser(events=("end",), tag="table")
+        for i in range(0, len(text), CHUNK_SIZE):
+            parser.feed(text[i:i+CHUNK_SIZE])
+            yield from self._outer_tables(parser)
+        parser.close()
+        yield from self._outer_tables(parser)
+
+    def _outer_tables(self, parser):
+        for _, t in parser.read_events():
+            # a nested table ends before its outer table, it is given after the outer one
+            if next(t.iterancestors("table"), None) is not None: continue
+            etree.strip_elements(t, "script", "style", with_tail=False)
+            yield t
+            for inner in t.iterdescendants("table"):
+                yield inner
+            # all before t is parsed and read, drop it
+            t.clear()
+            parent = t.getparent()
+            if parent is not None:
+                while t.getprevious() is not None: del parent[0]
+
+    def text(self, el):
+        # same as "".join(el.itertext()), without a python str per text node
+        return etree.tostring(el, method="text", encoding=str, with_tail=False)
+
+    def ps(self, el):
+        return el.findall(".//p")
+
+    def lines(self, el):
+        lines = [s.strip() for s in el.itertext()]
+        lines = [s for s in lines if s]
+        return "\n".join(lines).split("\n")
+
+    def same(self, a, b):
+        if a is b: return True
+        return etree.tostring(a, with_tail=False) == etree.tostring(b, with_tail=False)
+
+BACKENDS = {
+    "bs4" : Bs4Backend(),
+    "lxml": LxmlBackend(),
+}
+
+def get(name):
+    if name not in BACKENDS:
+        raise ValueError("Unknown html backend: %s, choose from %s" % (name, list(BACKENDS.keys())))
+    return BACKENDS[name]
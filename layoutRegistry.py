@@ -0,0 +1,123 @@
+"""
+Registry of the known court list layouts
+
+A page's layout is fingerprinted by the kinds of metadata rows above its
+first header row (e.g. "法庭 Court No. : ... 聆案官 : ... Master : ...")
+and the names in the header row, see courtParser.read_layout.
+layouts.json maps each fingerprint to the state machine reading it,
+one of courtParser.LAYOUTS, so courtParser picks the transit table
+by what the page looks like, not by its court code.
+
+A page with a fingerprint not in the registry is reported as soon as its
+header is read, a court changing its list or a todo code (LT, OAT, SCT, CRC)
+shows up without waiting for a parse to give no events.
+
+Usage:
+python layoutRegistry.py [--archive archive] [--backend lxml] [--register] [CODE ...]
+    tally the layouts of the archived pages, --register adds the unknown
+    ones of the codes in courtParser.transit_map, with the layout of their code
+"""
+import argparse
+import hashlib
+import json
+import os
+from collections import OrderedDict
+
+REGISTRY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "layouts.json")
+
+def fingerprint(metadata, headers):
+    """
+    short hash of the metadata row kinds and the header names of a page
+    """
+    key = json.dumps([metadata, headers], ensure_ascii=False)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:12]
+
+class Registry(object):
+    """
+    fingerprint -> {"layout", "metadata", "headers", "codes"}, kept in a json file
+    """
+    def __init__(self, path=REGISTRY_PATH):
+        self.path = path
+        self.entries = OrderedDict()
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                self.entries = json.load(f, object_pairs_hook=OrderedDict)
+
+    def get(self, fp):
+        return self.entries.get(fp)
+
+    def add(self, layout, metadata, headers, code):
+        """
+        register the layout of a page of court code, returns its fingerprint
+        """
+        fp = fingerprint(metadata, headers)
+        entry = self.entries.setdefault(fp, OrderedDict([
+            ("layout"  , layout),
+            ("metadata", metadata),
+            ("headers" , headers),
+            ("codes"   , []),
+        ]))
+        if code not in entry["codes"]: entry["codes"] = sorted(entry["codes"] + [code])
+        return fp
+
+    def save(self):
+        tmpPath = self.path + ".tmp"
+        with open(tmpPath, 'w', encoding="utf-8") as f:
+            json.dump(self.entries, f, indent=1, ensure_ascii=False)
+            f.write("\n")
+        os.replace(tmpPath, self.path)
+
+_registry = None
+def default():
+    """
+    the Registry of REGISTRY_PATH, loaded once per process
+    """
+    global _registry
+    if _registry is None: _registry = Registry()
+    return _registry
+
+if __name__=="__main__":
+    import courtParser as cp
+    from archive import Archive
+    from archive import ARCHIVE_DIR
+
+    parser = argparse.ArgumentParser(description="Tally the layouts of the archived pages")
+    parser.add_argument("--archive" , default=ARCHIVE_DIR)
+    parser.add_argument("--backend" , default=None, help="html backend for courtParser, bs4 or lxml")
+    parser.add_argument("--register", action="store_true", help="register the unknown layouts of the codes in transit_map")
+    parser.add_argument("codes", nargs="*", help="court codes to scan, default: all")
+    args = parser.parse_args()
+    codes = [c.upper() for c in args.codes]
+
+    registry = default()
+    archive = Archive(args.archive)
+    seen = OrderedDict()   # fp -> [metadata, headers, {code: no. of pages}, first page]
+    for code, dateYMD in archive.pairs():
+        if codes and code not in codes: continue
+        text = archive.read(code, dateYMD)
+        if not text or "There is no hearing on this day" in text: continue
+        metadata, headers = cp.page_layout(text, args.backend)
+        if headers is None: continue
+        fp = fingerprint(metadata, headers)
+        if fp not in seen: seen[fp] = [metadata, headers, {}, (code, dateYMD)]
+        seen[fp][2][code] = seen[fp][2].get(code, 0) + 1
+    archive.close()
+
+    nRegistered = 0
+    for fp, (metadata, headers, byCode, first) in seen.items():
+        entry = registry.get(fp)
+        print ("%s %-6s %s" % (fp, entry["layout"] if entry else "?", " ".join("%s:%d" % kv for kv in sorted(byCode.items()))))
+        print ("    metadata %s headers %s, first %s %s" % ((metadata, headers) + first))
+        if not args.register: continue
+        for code in sorted(byCode):
+            if entry and code in entry["codes"]: continue
+            # a known layout keeps its state machine, even on a new code
+            layout = entry["layout"] if entry else cp.layout_of_code(code)
+            if layout is None:
+                print ("    %s has no state machine, not registered" % code)
+                continue
+            registry.add(layout, metadata, headers, code)
+            nRegistered += 1
+    if nRegistered:
+        registry.save()
+        print ("Registered %d (layout, code) in %s" % (nRegistered, registry.path))
@@ -0,0 +1,137 @@
+"""
+Counters and timers of the parse and persist stages, by court code
+
+    with metrics.timed("explode", code):
+        ...
+    metrics.add("read_row", code, sec)
+    metrics.count("events", code, n)
+
+stages timed:
+    html                : building the html tree / pulling the next table, see htmlBackend.py
+    explode             : Extractor exploding a table
+    find_metadata* , find_header , read_row : the courtParser state machine states
+    lookup              : getting or creating the judges, cases, tags, lawyers of an event
+    write               : the executemany of a bulkPersist.py batch, under code "all"
+    commit              : DB commits, under code "all" as a batch can hold many courts
+counts:
+    pages, pages_without_events, tables, events : by courtParser
+    events_failed       : by persist.py
+    refresh_skipped     : by pipeline.py, refreshed pages giving no events, their saved events kept
+
+Each process has its own metrics, a parse worker sends its back with take()
+and the parent merge()s them, see pipeline.py
+
+At the end of a run they are written with write(path), as a Prometheus
+textfile (e.g. for node_exporter's textfile collector) if path ends with .prom,
+as JSON otherwise. The path defaults to the COURT_METRICS_PATH env var.
+"""
+import json
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+PREFIX = "courtparser"
+ALL_CODES = "all"
+METRICS_PATH = os.environ.get("COURT_METRICS_PATH")
+
+calls  = defaultdict(int)   # (stage, code) -> no. of times timed
+secs   = defaultdict(float) # (stage, code) -> sec spent
+counts = defaultdict(int)   # (name, code)  -> count
+
+def add(stage, code, sec, n=1):
+    key = (stage, code)
+    calls[key] += n
+    secs[key]  += sec
+
+@contextmanager
+def timed(stage, code):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        add(stage, code, time.perf_counter() - t0)
+
+def count(name, code, n=1):
+    counts[(name, code)] += n
+
+def reset():
+    calls.clear()
+    secs.clear()
+    counts.clear()
+
+def to_dict():
+    """
+    {"stages": {stage: {code: {"calls": n, "sec": s}}}, "counts": {name: {code: n}}}
+    """
+    stages = {}
+    for (stage, code), n in sorted(calls.items()):
+        stages.setdefault(stage, {})[code] = {"calls": n, "sec": secs[(stage, code)]}
+    named = {}
+    for (name, code), n in sorted(counts.items()):
+        named.setdefault(name, {})[code] = n
+    return {"stages": stages, "counts": named}
+
+def take():
+    """
+    to_dict() and reset, for a worker to send back what it measured since the last take()
+    """
+    d = to_dict()
+    reset()
+    return d
+
+def merge(d):
+    """
+    add the metrics in d, as given by to_dict(), to this process' ones
+    """
+    for stage, byCode in d["stages"].items():
+        for code, v in byCode.items():
+            add(stage, code, v["sec"], v["calls"])
+    for name, byCode in d["counts"].items():
+        for code, n in byCode.items():
+            count(name, code, n)
+
+def to_prometheus():
+    """
+    the metrics in the Prometheus text exposition format
+    """
+    lines = []
+    def metric(name, help, samples):
+        lines.append("# HELP %s_%s %s" % (PREFIX, name, help))
+        lines.append("# TYPE %s_%s counter" % (PREFIX, name))
+        for labels, v in samples:
+            labels = ",".join('%s="%s"' % kv for kv in labels)
+            lines.append("%s_%s{%s} %s" % (PREFIX, name, labels, repr(v)))
+
+    metric("stage_seconds_total", "Seconds spent in each stage",
+           [((("stage", stage), ("code", code)), secs[(stage, code)]) for stage, code in sorted(calls)])
+    metric("stage_calls_total", "Times each stage was run",
+           [((("stage", stage), ("code", code)), n) for (stage, code), n in sorted(calls.items())])
+    for name in sorted(set(name for name, _ in counts)):
+        metric("%s_total" % name, "No. of %s" % name.replace("_", " "),
+               [((("code", code),), n) for (name_, code), n in sorted(counts.items()) if name_==name])
+    return "\n".join(lines) + "\n"
+
+def write(path=None):
+    """
+    write the metrics to path, or METRICS_PATH, nothing if neither is set
+    the file is replaced at once so a collector never reads it half written
+    """
+    path = path or METRICS_PATH
+    if not path: return
+    text = to_prometheus() if path.endswith(".prom") else json.dumps(to_dict(), indent=2, sort_keys=True)
+    tmpPath = path + ".tmp"
+    with open(tmpPath, 'w') as f:
+        f.write(text)
+    os.replace(tmpPath, path)
+    print ("Metrics written to %s" % path)
+
+def summary():
+    """
+    one line per stage, sec spent and no. of calls over all codes
+    """
+    total = defaultdict(lambda: [0, 0.0])
+    for (stage, code), n in calls.items():
+        total[stage][0] += n
+        total[stage][1] += secs[(stage, code)]
+    return "\n".join("%-20s n=%-8d %8.3fs" % (stage, n, s) for stage, (n, s) in sorted(total.items(), key=lambda x: -x[1][1]))
@@ -0,0 +1,104 @@
+"""
+Local cache of parsed pages
+
+Re-parsing the archive after a change that does not touch the parser
+gives back the same records for every page, they are kept here instead.
+An entry is keyed by the sha256 of the page text, the court code, the date
+(the records carry it), hide_parties and the html backend, and stored as a
+zlib-ed pickle under
+    parse_cache/ab/abcdef....CODE.YYYYMMDD.h.lxml.bin
+where abcdef... is the sha256, the same as in archive.py.
+
+Each entry records the layout the page was read with, its fingerprint in
+layoutRegistry.py and courtParser.parser_version of the layout, an entry is a miss
+- of an older version, so bumping courtParser.PARSER_VERSION or LAYOUT_VERSIONS[layout]
+  drops the results of the layouts whose parsing changed and keeps the others
+- if layouts.json now maps its fingerprint to another layout, or registers a
+  fingerprint that was read with the layout of its court code
+
+Many parse worker processes share the cache, an entry is one file
+written at once, so no locking is needed.
+
+Usage:
+    cache = parseCache.ParseCache()
+    records = cache.parse_records(code, dateYMD, text)
+"""
+import hashlib
+import os
+import pickle
+import threading
+import zlib
+
+import courtParser as cp
+import metrics
+
+CACHE_DIR = "parse_cache"
+
+def text_sha(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class ParseCache(object):
+    def __init__(self, root=CACHE_DIR):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, sha, code, dateYMD, hide_parties, backend):
+        name = "%s.%s.%s.%s.%s.bin" % (sha, code, dateYMD, "h" if hide_parties else "s", backend or cp.DEFAULT_BACKEND)
+        return os.path.join(self.root, sha[:2], name)
+
+    def get(self, sha, code, dateYMD, hide_parties=True, backend=None):
+        """
+        the cached records, None if not cached, cached by an older parser or with another layout
+        """
+        try:
+            with open(self._path(sha, code, dateYMD, hide_parties, backend), 'rb') as f:
+                layout, fp, version, rows = pickle.loads(zlib.decompress(f.read()))
+        except (OSError, ValueError, EOFError, zlib.error, pickle.UnpicklingError):
+            return None
+        if version != cp.parser_version(layout): return None
+        if layout != cp.layout_of_fingerprint(code, fp): return None
+        # stored as plain tuples, not depending on how EventRecord is pickled
+        if rows and len(rows[0]) != len(cp.EventRecord._fields): return None
+        return [cp.EventRecord(*row) for row in rows]
+
+    def put(self, sha, code, dateYMD, hide_parties, backend, layout, fp, records):
+        data = zlib.compress(pickle.dumps(
+            (layout, fp, cp.parser_version(layout), [tuple(r) for r in records]), pickle.HIGHEST_PROTOCOL))
+        path = self._path(sha, code, dateYMD, hide_parties, backend)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmpPath = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+        with open(tmpPath, 'wb') as f:
+            f.write(data)
+        os.replace(tmpPath, path)
+
+    def parse_records(self, code, dateYMD, text, hide_parties=True, backend=None):
+        """
+        courtParser.parse_records, from the cache if the page was parsed by the same parser before
+        """
+        sha = text_sha(text)
+        records = self.get(sha, code, dateYMD, hide_parties, backend)
+        if records is not None:
+            self.hits += 1
+            metrics.count("cache_hits", code)
+            return records
+        self.misses += 1
+        metrics.count("cache_misses", code)
+        info = {}
+        records = cp.parse_records(code, dateYMD, text, hide_parties, backend, info)
+        # a page no layout could read is not cached, it is reported again next time
+        if info.get("layout") is not None:
+            self.put(sha, code, dateYMD, hide_parties, backend, info["layout"], info["fingerprint"], records)
+        return records
+
+    def __repr__(self):
+        return "<ParseCache %s hits=%d misses=%d>" % (self.root, self.hits, self.misses)
+
+_caches = {}
+def cache_at(root=CACHE_DIR):
+    """
+    the ParseCache of root, one per process, e.g. for the parse workers
+    """
+    if root not in _caches: _caches[root] = ParseCache(root)
+    return _caches[root]
@@ -0,0 +1,228 @@
+"""
+Save parsed events to the DB
+
+courtParser.parse_records gives EventRecord with the judges, cases, tags
+and lawyers only named, here they are got or created in dm.session
+and the events are written.
+
+All the records of a save_records call, or of a BatchWriter batch, are
+written in a single transaction, so SQLite syncs to disk once per batch
+instead of once per event. Each record is saved under its own savepoint,
+a bad one is rolled back and skipped without losing the rest.
+
+The records can be any iterable, e.g. courtParser.iter_records, which
+yields them as the page is parsed, so saving starts before the page is
+fully read and the page's records are never all held at once.
+
+Usage:
+    session = dm.init("sqlite:///data.sqlite")
+    events = persist.save_records(courtParser.iter_records(code, dateYMD, text))
+"""
+import time
+from collections import OrderedDict
+from datetime import datetime
+from datetime import timedelta
+
+from sqlalchemy.exc import SQLAlchemyError
+
+import dataModel as dm
+import metrics
+
+# events per commit for bulk loads, e.g. backfill
+BATCH_SIZE = 500
+
+# fields of an Event holding a list of entities
+ENTITY_FIELDS = ["judges", "cases", "tags", "lawyers", "lawyers_atk", "lawyers_def"]
+SCALAR_FIELDS = ["category", "court", "datetime", "parties", "parties_atk", "parties_def"]
+
+def unique(l):
+    return list(OrderedDict.fromkeys(l))
+
+def resolve_record(rec):
+    """
+    EventRecord -> dict of Event field values, with the Judge/Case/Tag/Lawyer got or created in dm.session
+    the time taken is the "lookup" stage in metrics.py
+    """
+    t0 = time.perf_counter()
+    def zh_or_en(cls, pairs):
+        return unique([cls.get_or_create_zh_or_en(name_zh=zh, name_en=en) for zh, en in pairs])
+
+    fields = dict( (f, getattr(rec, f)) for f in SCALAR_FIELDS )
+    fields["judges"] = zh_or_en(dm.Judge, rec.judges)
+    cases = []
+    for caseNo, desc in rec.cases:
+        case = dm.Case.get_or_create(caseNo=caseNo)
+        if desc and case.description==None: case.description = desc
+        cases.append(case)
+    fields["cases"]       = unique(cases)
+    fields["tags"]        = zh_or_en(dm.Tag   , rec.tags)
+    fields["lawyers"]     = zh_or_en(dm.Lawyer, rec.lawyers)
+    fields["lawyers_atk"] = zh_or_en(dm.Lawyer, rec.lawyers_atk)
+    fields["lawyers_def"] = zh_or_en(dm.Lawyer, rec.lawyers_def)
+    metrics.add("lookup", rec.category, time.perf_counter() - t0)
+    return fields
+
+def set_fields(e, fields):
+    for f, v in fields.items():
+        setattr(e, f, v)
+
+def new_event(rec):
+    e = dm.Event()
+    set_fields(e, resolve_record(rec))
+    return e
+
+def save_nested(records):
+    """
+    resolve the entities of the records and add them as Events to the current transaction
+    each record gets its own savepoint, a record failing to save is rolled back alone
+    returns (list of the dm.Event added, no. of records failed)
+    """
+    events = []
+    nFailed = 0
+    for rec in records:
+        savepoint = dm.session.begin_nested()
+        try:
+            e = new_event(rec)
+            dm.session.add(e)
+            savepoint.commit()
+        except SQLAlchemyError as err:
+            print ("Fail saving %s %s: %s"%(rec.category, rec.datetime, err))
+            savepoint.rollback()
+            metrics.count("events_failed", rec.category)
+            nFailed += 1
+            continue
+        events.append(e)
+    return events, nFailed
+
+def commit():
+    """
+    dm.session.commit(), returns False and rolls back if it failed
+    """
+    try:
+        with metrics.timed("commit", metrics.ALL_CODES):
+            dm.session.commit()
+    except SQLAlchemyError as err:
+        print (err)
+        dm.session.rollback()
+        return False
+    return True
+
+def save_records(records):
+    """
+    save the records as Events, in one commit
+    returns list of dm.Event, empty if the commit failed
+    """
+    events, _ = save_nested(records)
+    if not commit(): return []
+    return events
+
+class BatchWriter(object):
+    """
+    saves pages of records, committing every batchSize events
+    instead of once per event, or once per page if batchSize is None
+
+    on_commit(ok) given to add() is called once the records are committed,
+    ok is False if the commit failed and they are lost
+    """
+    def __init__(self, batchSize=None):
+        self.batchSize = batchSize
+        self.pending = 0     # events added since the last commit
+        self.waiting = []    # on_commit of the pages added since the last commit
+        self.rows = 0        # events committed
+        self.failed = 0      # events not saved
+        self.sec = 0.0       # time spent in add() and commit()
+
+    def add(self, records, on_commit=None):
+        t0 = time.perf_counter()
+        events, nFailed = save_nested(records)
+        self.failed  += nFailed
+        self.pending += len(events)
+        if on_commit: self.waiting.append(on_commit)
+        self.sec += time.perf_counter() - t0
+        if self.batchSize is None or self.pending >= self.batchSize:
+            self.commit()
+        return events
+
+    def commit(self):
+        t0 = time.perf_counter()
+        ok = commit()
+        if ok:
+            self.rows   += self.pending
+        else:
+            self.failed += self.pending
+        self.pending = 0
+        waiting, self.waiting = self.waiting, []
+        self.sec += time.perf_counter() - t0
+        for on_commit in waiting: on_commit(ok)
+        return ok
+
+    def rate(self):
+        """
+        events committed per sec spent writing
+        """
+        return self.rows / self.sec if self.sec else 0.0
+
+    def __repr__(self):
+        return "<BatchWriter rows=%d failed=%d %.1f rows/sec>" % (self.rows, self.failed, self.rate())
+
+def changed_fields(e, fields):
+    """
+    the fields whose value differs from those of the saved Event e
+    entity lists are compared as sets of ids
+    """
+    changed = {}
+    for f in SCALAR_FIELDS:
+        if getattr(e, f) != fields[f]: changed[f] = fields[f]
+    for f in ENTITY_FIELDS:
+        if set(x.id for x in getattr(e, f)) != set(x.id for x in fields[f]): changed[f] = fields[f]
+    return changed
+
+def refresh_page(code, dateYMD, records):
+    """
+    make the saved events of (code, dateYMD) the same as records,
+    inserting, updating or deleting only the events that changed
+
+    Events are matched by their case nos., the n-th event of a case no. set
+    in records is matched to the n-th saved one with the same set.
+    Empty records delete all the saved events, only for a "no hearing" page.
+    returns (inserted, updated, deleted)
+    """
+    day = datetime.strptime(dateYMD, "%Y%m%d")
+    saved = dm.session.query(dm.Event) \
+                      .filter(dm.Event.category == code) \
+                      .filter(dm.Event.datetime >= day) \
+                      .filter(dm.Event.datetime <  day + timedelta(days=1)) \
+                      .order_by(dm.Event.id).all()
+
+    savedByKey = {}
+    for e in saved:
+        key = tuple(sorted(c.caseNo for c in e.cases))
+        savedByKey.setdefault(key, []).append(e)
+
+    inserted = updated = 0
+    try:
+        for rec in records:
+            key = tuple(sorted(caseNo for caseNo, _ in rec.cases))
+            fields = resolve_record(rec)
+            if savedByKey.get(key):
+                e = savedByKey[key].pop(0)
+                changed = changed_fields(e, fields)
+                if changed:
+                    set_fields(e, changed)
+                    updated += 1
+            else:
+                e = dm.Event()
+                set_fields(e, fields)
+                dm.session.add(e)
+                inserted += 1
+
+        leftover = [e for l in savedByKey.values() for e in l]
+        for e in leftover:
+            dm.session.delete(e)
+        with metrics.timed("commit", metrics.ALL_CODES):
+            dm.session.commit()
+    except SQLAlchemyError as err:
+        print (err)
+        dm.session.rollback()
+        return 0, 0, 0
+    return inserted, updated, len(leftover)
@@ -0,0 +1,191 @@
+"""
+Fetch -> parse -> persist pipeline
+
+    source thread  : fetches (or reads from the archive) the pages
+    parse stage    : courtParser.parse_records in a process pool
+    writer         : the calling thread, the only one touching dm.session
+
+The stages are connected by bounded queues, so a slow stage holds back
+the ones before it instead of piling up pages in memory.
+
+With refresh=True the writer updates the saved events of each page in
+place (see persist.refresh_page) instead of adding a new copy of them, so a page
+can be re-scraped during the day as the court lists change.
+
+A parse worker runs courtParser.parse_records, which needs no DB, and
+sends back the EventRecord, the writer then resolves the
+Judge/Case/Tag/Lawyer of each record in the real DB, see persist.py
+It also sends back the metrics.py stage timings of the page, so those of
+the whole run end up in the writer's process.
+
+Usage:
+    session = dm.init("sqlite:///data.sqlite")
+    pipeline.run(pipeline.fetch_source(jobs), on_done=...)
+"""
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import courtParser as cp
+import fetcher
+import bulkPersist
+import metrics
+import parseCache
+import persist
+from archive import text_sha
+
+QUEUE_SIZE = 32
+
+#===========================================
+# parse stage, runs in the worker processes
+#===========================================
+def timed_parse_page(code, dateYMD, text, hide_parties=True, backend=None, cacheDir=None):
+    """
+    courtParser.parse_records, through the parseCache.py of cacheDir if given
+    returns (records, sec taken, metrics of the page)
+    """
+    t0 = time.perf_counter()
+    if cacheDir:
+        records = parseCache.cache_at(cacheDir).parse_records(code, dateYMD, text, hide_parties, backend)
+    else:
+        records = cp.parse_records(code, dateYMD, text, hide_parties, backend)
+    return records, time.perf_counter() - t0, metrics.take()
+
+#===========================================
+# sources, put(code, dateYMD, text) each page
+#===========================================
+def fetch_source(jobs, concurrency=fetcher.DEFAULT_CONCURRENCY, archive=None, skip_unchanged=True, controller=None):
+    def source(put):
+        return fetcher.run(jobs, put, concurrency=concurrency, archive=archive, skip_unchanged=skip_unchanged, controller=controller)
+    return source
+
+def archive_source(archive, codes):
+    def source(put):
+        for code in codes:
+            for _, dateYMD in archive.pairs(code):
+                put(code, dateYMD, archive.read(code, dateYMD))
+    return source
+
+#===========================================
+# the pipeline
+#===========================================
+def run(source, hide_parties=True, workers=None, on_done=None, queueSize=QUEUE_SIZE, stats=None, refresh=False, backend=None,
+        batchSize=None, cacheDir=None, bulk=False, archive=None):
+    """
+    source(put) is run in its own thread and should call put(code, dateYMD, text) for each page
+    on_done(code, dateYMD, status, nEvents) is called by the writer for each page,
+    once its events are committed, status is "ok", "empty" for no hearing pages,
+    or "fail" if parsing or saving failed
+    batchSize: commit every batchSize events, default once per page, see persist.BatchWriter
+    if stats is a dict, the sec taken by each page in the "parse" and "persist" stage
+    are appended to stats["parse"] and stats["persist"], and the rows/sec of the writer
+    is put in stats["rows_per_sec"]
+    if refresh, the saved events of each page are updated to match it, see persist.refresh_page
+    a page giving no events is then skipped as "fail", only a "no hearing" page deletes the saved ones
+    backend is the html backend for courtParser.parse, see htmlBackend.py
+    cacheDir: reuse the records of pages parsed before by the same parser, see parseCache.py
+    bulk: write with bulkPersist.BulkWriter instead of the ORM, for large imports
+    archive: the archive.Archive the fetcher compares pages against, each page saved
+             ("ok" or "empty") is marked there with Archive.mark_persisted
+    returns (what source returned, no. of pages, no. of events)
+    an exception raised by source is raised again once the pages it put are saved
+    """
+    if stats is not None:
+        stats.setdefault("parse", [])
+        stats.setdefault("persist", [])
+    workers = workers or os.cpu_count() or 1
+    pageQ   = queue.Queue(maxsize=queueSize)
+    recordQ = queue.Queue(maxsize=queueSize)
+    sourceResult = [None]
+    sourceError = []
+
+    def source_thread():
+        try:
+            sourceResult[0] = source(lambda code, dateYMD, text: pageQ.put( (code, dateYMD, text) ))
+        except Exception as e:
+            sourceError.append(e)
+        finally:
+            pageQ.put(None)
+
+    def parse_thread():
+        # at most 2 pages per worker submitted but not yet picked up by the writer
+        inflight = threading.BoundedSemaphore(workers*2)
+
+        def done(code, dateYMD, sha, future):
+            try:
+                result = future.result()
+            except Exception as e:
+                result = e
+            recordQ.put( (code, dateYMD, sha, result) )
+            inflight.release()
+
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                for code, dateYMD, text in iter(pageQ.get, None):
+                    sha = text_sha(text) if archive else None
+                    if len(text)==0 or "There is no hearing on this day" in text:
+                        recordQ.put( (code, dateYMD, sha, None) )
+                        continue
+                    inflight.acquire()
+                    future = pool.submit(timed_parse_page, code, dateYMD, text, hide_parties, backend, cacheDir)
+                    future.add_done_callback(lambda f, code=code, dateYMD=dateYMD, sha=sha: done(code, dateYMD, sha, f))
+        finally:
+            recordQ.put(None)
+
+    threads = [threading.Thread(target=source_thread, daemon=True),
+               threading.Thread(target=parse_thread , daemon=True)]
+    for t in threads: t.start()
+
+    def finished(code, dateYMD, sha, status, nEvents):
+        # only once saved, a page failing here is not seen as unchanged by the next fetch
+        if archive and status != "fail": archive.mark_persisted(code, dateYMD, sha)
+        if on_done: on_done(code, dateYMD, status, nEvents)
+
+    writer = bulkPersist.BulkWriter(batchSize) if bulk else persist.BatchWriter(batchSize)
+    nPages = 0
+    nEvents = 0
+    t0 = time.perf_counter()
+    for code, dateYMD, sha, result in iter(recordQ.get, None):
+        nPages += 1
+        if result is None:
+            if refresh:
+                # "There is no hearing on this day", every hearing of the day could have been cancelled
+                print ("Refreshed %s %s: +%d ~%d -%d"%((code, dateYMD) + persist.refresh_page(code, dateYMD, [])))
+            finished(code, dateYMD, sha, "empty", 0)
+            continue
+        if isinstance(result, Exception):
+            print("Fail parsing %s %s"%(code, dateYMD))
+            print(result)
+            finished(code, dateYMD, sha, "fail", 0)
+            continue
+        result, parseSec, pageMetrics = result
+        metrics.merge(pageMetrics)
+        nEvents += len(result)
+        print ("Events parsed from %s %s: %d"%(code, dateYMD, len(result)))
+        t1 = time.perf_counter()
+        if refresh and not result:
+            # a maintenance page, an unknown layout..., not a list with every hearing cancelled,
+            # keep the saved events
+            print ("No events parsed from %s %s, saved events kept"%(code, dateYMD))
+            metrics.count("refresh_skipped", code)
+            finished(code, dateYMD, sha, "fail", 0)
+        elif refresh:
+            print ("Refreshed %s %s: +%d ~%d -%d"%((code, dateYMD) + persist.refresh_page(code, dateYMD, result)))
+            finished(code, dateYMD, sha, "ok", len(result))
+        else:
+            def committed(ok, code=code, dateYMD=dateYMD, sha=sha, n=len(result)):
+                finished(code, dateYMD, sha, "ok" if ok else "fail", n)
+            writer.add(result, committed)
+        if stats is not None:
+            stats["parse"  ].append(parseSec)
+            stats["persist"].append(time.perf_counter() - t1)
+    writer.commit()
+
+    for t in threads: t.join()
+    # the pages the source gave before failing are saved, then its error is raised here
+    if sourceError: raise sourceError[0]
+    if stats is not None: stats["rows_per_sec"] = writer.rate()
+    print ("Pipeline: %d pages, %d events in %.1fs, %s"%(nPages, nEvents, time.perf_counter()-t0, writer))
+    return sourceResult[0], nPages, nEvents
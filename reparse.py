@@ -0,0 +1,170 @@
+"""
+Parallel re-parse of the whole archive into a fresh DB
+
+For a full history re-parse after a parser fix.
+The archived (code, date) pairs, sorted, are dealt round robin into shards.
+Each shard is parsed by a worker process with courtParser.parse_records and
+written to its own record stream, a file of pickled
+(code, dateYMD, [EventRecord, ...]) in (code, date) order.
+
+The streams are then merged in (code, date) order by a single writer,
+which gets or creates the Judge/Lawyer/Tag/Case of every record, so the
+same name from different shards ends up as one row. The merge order does not
+depend on the no. of shards, the output DB is the same however many
+workers parsed it.
+
+The per stage timings of the workers and the writer are merged in
+metrics.py, --metrics writes them out at the end.
+
+With --cache, pages already parsed by the same parser version are not
+parsed again, see parseCache.py, e.g. for a DB rebuild after a schema change.
+
+With --bulk, the merge writes through bulkPersist.py.
+
+Usage:
+python reparse.py data_reparse.sqlite [--archive archive] [--workers 4] [--backend lxml] [--metrics reparse.prom]
+                                      [--cache parse_cache] [--bulk] [--profile bulk_import] [CODE ...]
+"""
+import argparse
+import heapq
+import io
+import contextlib
+import os
+import pickle
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import bulkPersist
+import dataModel as dm
+import courtParser as cp
+import metrics
+import parseCache
+import persist
+from archive import Archive
+from archive import ARCHIVE_DIR
+
+def make_shards(pairs, nShards):
+    """
+    deal sorted pairs round robin, each shard stays sorted
+    """
+    pairs = sorted(pairs)
+    return [pairs[i::nShards] for i in range(nShards) if pairs[i::nShards]]
+
+def parse_shard(archiveRoot, pairs, outPath, hide_parties=True, backend=None, cacheDir=None):
+    """
+    runs in a worker process, parse pairs and write them to the record stream at outPath
+    through the parseCache.py of cacheDir if given
+    returns (no. of pages, no. of events, list of failed pairs, metrics of the shard)
+    """
+    metrics.reset()
+    archive = Archive(archiveRoot)
+    parse_records = parseCache.cache_at(cacheDir).parse_records if cacheDir else cp.parse_records
+    nPages = nEvents = 0
+    failed = []
+    with open(outPath, 'wb') as f:
+        for code, dateYMD in pairs:
+            text = archive.read(code, dateYMD)
+            nPages += 1
+            if not text or "There is no hearing on this day" in text: continue
+            try:
+                # the parser is chatty, keep the worker output readable
+                with contextlib.redirect_stdout(io.StringIO()):
+                    records = parse_records(code, dateYMD, text, hide_parties, backend)
+            except Exception as e:
+                print ("Fail parsing %s %s: %s"%(code, dateYMD, e))
+                failed.append( (code, dateYMD) )
+                continue
+            pickle.dump( (code, dateYMD, records), f, pickle.HIGHEST_PROTOCOL )
+            nEvents += len(records)
+    archive.close()
+    return nPages, nEvents, failed, metrics.take()
+
+def read_stream(path):
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+def merge(paths, batchSize=persist.BATCH_SIZE, bulk=False):
+    """
+    save the records of all streams to dm.session, in (code, date) order
+    with bulkPersist.BulkWriter if bulk, else persist.BatchWriter
+    returns the writer used
+    """
+    writer = bulkPersist.BulkWriter(batchSize) if bulk else persist.BatchWriter(batchSize)
+    streams = [read_stream(p) for p in paths]
+    for code, dateYMD, records in heapq.merge(*streams, key=lambda x: (x[0], x[1])):
+        writer.add(records)
+    writer.commit()
+    return writer
+
+def run(archiveRoot=ARCHIVE_DIR, codes=None, workers=None, hide_parties=True, backend=None, workDir=None, cacheDir=None,
+        bulk=False):
+    """
+    re-parse the archive into dm.session, see the module doc
+    codes: only re-parse these codes, default all
+    workDir: where the record streams go, a temp dir removed afterwards if None
+    cacheDir: reuse the records of pages parsed before by the same parser, see parseCache.py
+    bulk: write with bulkPersist.py instead of the ORM, the DB is the same
+    returns (no. of pages, no. of events, list of failed pairs)
+    """
+    workers = workers or os.cpu_count() or 1
+    archive = Archive(archiveRoot)
+    pairs = [p for p in archive.pairs() if not codes or p[0] in codes]
+    archive.close()
+    shards = make_shards(pairs, workers)
+
+    tmpDir = workDir or tempfile.mkdtemp(prefix="reparse_")
+    os.makedirs(tmpDir, exist_ok=True)
+    paths = [os.path.join(tmpDir, "shard_%03d.pkl"%i) for i in range(len(shards))]
+    try:
+        t0 = time.perf_counter()
+        nPages = nEvents = 0
+        failed = []
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(parse_shard, archiveRoot, shard, path, hide_parties, backend, cacheDir)
+                       for shard, path in zip(shards, paths)]
+            for future in futures:
+                p, e, f, m = future.result()
+                metrics.merge(m)
+                nPages += p
+                nEvents += e
+                failed += f
+        t1 = time.perf_counter()
+        print ("Parsed %d pages, %d events in %d shards in %.1fs"%(nPages, nEvents, len(shards), t1-t0))
+
+        writer = merge(paths, bulk=bulk)
+        print ("Merged in %.1fs, %s"%(time.perf_counter()-t1, writer))
+    finally:
+        if workDir is None: shutil.rmtree(tmpDir, ignore_errors=True)
+    return nPages, nEvents, sorted(failed)
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Parallel re-parse of the archive into a fresh DB")
+    parser.add_argument("db", help="sqlite file to create")
+    parser.add_argument("--archive"      , default=ARCHIVE_DIR)
+    parser.add_argument("--workers"      , type=int, default=None, help="parse processes, default: no. of cores")
+    parser.add_argument("--backend"      , default=None, help="html backend for courtParser, bs4 or lxml")
+    parser.add_argument("--show-parties" , action="store_true", help="do not hide the parties names")
+    parser.add_argument("--keep"         , default=None, help="keep the record streams in this dir")
+    parser.add_argument("--metrics"      , default=None, help="write the stage timings to this file, .prom or .json")
+    parser.add_argument("--cache"        , default=None, help="parse cache dir, pages parsed before by the same parser are not parsed again")
+    parser.add_argument("--bulk"         , action="store_true", help="write with bulkPersist.py, executemany instead of the ORM")
+    parser.add_argument("--profile"      , default="bulk_import", help="sqlite settings, one of dataModel.PROFILES")
+    parser.add_argument("codes", nargs="*", help="court codes to re-parse, default: all")
+    args = parser.parse_args()
+
+    if os.path.exists(args.db):
+        print ("%s exists, re-parse goes into a fresh DB"%args.db)
+        raise SystemExit(1)
+
+    dm.init("sqlite:///" + args.db, profile=args.profile)
+    nPages, nEvents, failed = run(args.archive, [c.upper() for c in args.codes], args.workers,
+                                  not args.show_parties, args.backend, args.keep, args.cache, args.bulk)
+    for code, dateYMD in failed:
+        print ("Failed: %s %s"%(code, dateYMD))
+    metrics.write(args.metrics)
@@ -0,0 +1,139 @@
+"""
+Offline replay of the judiciary court list site
+
+Serves the pages in the local archive at
+    /dcl/view.jsp?lang=tc&date=ddmmyyyy&court=CODE
+(code, date) not in the archive get a "There is no hearing on this day" page.
+
+The server can be made to behave like a loaded one:
+    latency : mean sec before replying, +-50% uniform jitter
+    errorRate : fraction of requests answered with 503
+    maxRps : cap on requests per sec over all connections
+
+Usage:
+python replayServer.py [--port 8000] [--latency 0.2] [--error-rate 0.01] [--max-rps 20]
+then point fetcher.BASE_URL to http://127.0.0.1:8000/dcl/view.jsp
+"""
+import argparse
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from archive import Archive
+
+NO_HEARING_PAGE = "<html><body>There is no hearing on this day</body></html>"
+
+class TokenBucket(object):
+    """
+    allow at most rate requests per sec, with bursts of up to rate
+    the bucket holds at least 1 token, or a rate below 1/sec would never fill one
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = max(rate, 1)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self):
+        """
+        blocks until a token is available
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # keep-alive, like the real server
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if not url.path.endswith("view.jsp") or "date" not in query or "court" not in query:
+            self.reply(404, b"")
+            return
+
+        if server.bucket: server.bucket.take()
+        if server.latency: time.sleep(random.uniform(0.5, 1.5) * server.latency)
+        if random.random() < server.errorRate:
+            self.reply(503, b"")
+            return
+
+        dateDMY = query["date"][0]
+        dateYMD = dateDMY[4:8] + dateDMY[2:4] + dateDMY[0:2]
+        code = query["court"][0].upper()
+
+        last = server.archive.latest(code, dateYMD)
+        if not last:
+            self.reply(200, NO_HEARING_PAGE.encode("utf-8"))
+            return
+        etag = '"%s"' % last["sha256"]
+        if self.headers.get("If-None-Match") == etag:
+            self.reply(304, b"", etag)
+            return
+        self.reply(200, server.archive.get(last["sha256"]).encode("utf-8"), etag)
+
+    def reply(self, status, body, etag=None):
+        self.send_response(status)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        if etag: self.send_header("ETag", etag)
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except ConnectionError:
+            pass # client aborted, e.g. the fetcher found the page empty
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+def make_server(archive, port=0, latency=0.0, errorRate=0.0, maxRps=None, verbose=False):
+    """
+    port=0 picks a free port, see server.server_address
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), ReplayHandler)
+    server.daemon_threads = True
+    server.archive   = archive
+    server.latency   = latency
+    server.errorRate = errorRate
+    server.bucket    = TokenBucket(maxRps) if maxRps else None
+    server.verbose   = verbose
+    return server
+
+def start(archive, **kwargs):
+    """
+    run a server in a background thread
+    returns (server, base url for fetcher.BASE_URL)
+    """
+    server = make_server(archive, **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address
+    return server, "http://%s:%d/dcl/view.jsp" % (host, port)
+
+def add_arguments(parser):
+    parser.add_argument("--archive"   , default="archive", help="archive dir to serve")
+    parser.add_argument("--latency"   , type=float, default=0.0, help="mean reply latency in sec")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of 503 replies")
+    parser.add_argument("--max-rps"   , type=float, default=None, help="max requests per sec")
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Replay archived court lists over http")
+    parser.add_argument("--port", type=int, default=8000)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    server = make_server(Archive(args.archive), port=args.port, latency=args.latency,
+                         errorRate=args.error_rate, maxRps=args.max_rps, verbose=True)
+    print ("Serving %s on http://127.0.0.1:%d/dcl/view.jsp" % (args.archive, args.port))
+    server.serve_forever()
@@ -31,6 +31,12 @@ import pytz
 
 import dataModel as dm
 import courtParser as cp
+import fetcher
+import metrics
+import pipeline
+import backfill
+from archive import Archive
+from fetcher import header
 
 #the court codes
 codes = [
@@ -68,12 +74,10 @@ todo_codes = [
     "CRC",
 ]
 
-ua = "Mozilla/5.0 (Windows NT 6.1; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/69.0.3497.100 Safari/537.36"
-header = {
-    'User-Agent': ua
-}
+#max no. of pages being fetched at the same time
+concurrency = 8
 
-if len(sys.argv) == 3:
+if len(sys.argv) == 3 and sys.argv[1] not in ("refresh", "backfill"):
     #for debug
     code    = sys.argv[1]
     dateYMD = sys.argv[2]
@@ -98,25 +102,51 @@ if len(sys.argv) == 3:
 if len(sys.argv) == 1: 
     hkt = pytz.timezone('Asia/Hong_Kong')
     dateObj = datetime.now().replace(tzinfo=hkt).date() - timedelta(days=1)
-    dateDMY = datetime.strftime(dateObj, "%d%m%Y") # 01122018
     dateYMD = datetime.strftime(dateObj, "%Y%m%d")
 
-    session = dm.init("sqlite:///data.sqlite")
-
-    for code in codes:
-        code = code.upper()
-
-        url = "https://e-services.judiciary.hk/dcl/view.jsp?lang=tc&date={}&court={}".format(dateDMY, code)
-        print ("Parsing %s"% url)
-        r = requests.get(url, headers = header)
-        
-        text = r.text
-        if len(text)==0: continue
-        if "There is no hearing on this day" in text: continue    
-
-        try:
-            events = cp.parse(code, dateYMD, r.text, hide_parties=True)
-            print ("Events parsed from %s %s: %d"%(code, dateYMD, len(events)))
-        except Exception as e:
-            print("Fail parsing %s %s"%(code, dateYMD))
-            print(e)
\ No newline at end of file
+    session = dm.init("sqlite:///data.sqlite", profile="daily_scrape")
+
+    jobs = [(code.upper(), dateObj) for code in cp.rmDupElems(codes)]
+    archive = Archive()
+    source = pipeline.fetch_source(jobs, concurrency=concurrency, archive=archive)
+    # yesterday's lists may already be saved by the refresh runs, update them in place
+    # instead of adding a second copy, on a date with no saved events this is a plain insert
+    latencies, nPages, nEvents = pipeline.run(source, hide_parties=True, refresh=True, archive=archive)
+    fetcher.print_latencies(latencies)
+    metrics.write()
+
+if len(sys.argv) >= 4 and sys.argv[1] == "backfill":
+    # python scraper.py backfill 20180101 20181231 [CODE ...]
+    startYMD = sys.argv[2]
+    endYMD   = sys.argv[3]
+    backfillCodes = [c.upper() for c in sys.argv[4:]] or cp.rmDupElems(codes)
+    unknown = [c for c in backfillCodes if c not in codes]
+    if unknown:
+        print ("Unknown court code %s, exit" % unknown)
+        sys.exit(1)
+
+    session = dm.init("sqlite:///data.sqlite", profile="daily_scrape")
+    latencies = backfill.run(backfillCodes, startYMD, endYMD, hide_parties=True, concurrency=concurrency, archive=Archive())
+    fetcher.print_latencies(latencies)
+    metrics.write()
+
+if len(sys.argv) >= 2 and sys.argv[1] == "refresh":
+    # python scraper.py refresh [CODE ...]
+    # re-scrape today's lists, only the events that changed since the last run are written
+    refreshCodes = [c.upper() for c in sys.argv[2:]] or cp.rmDupElems(codes)
+    unknown = [c for c in refreshCodes if c not in codes]
+    if unknown:
+        print ("Unknown court code %s, exit" % unknown)
+        sys.exit(1)
+
+    hkt = pytz.timezone('Asia/Hong_Kong')
+    dateObj = datetime.now(hkt).date()
+
+    session = dm.init("sqlite:///data.sqlite", profile="daily_scrape")
+
+    jobs = [(code, dateObj) for code in refreshCodes]
+    archive = Archive()
+    source = pipeline.fetch_source(jobs, concurrency=concurrency, archive=archive)
+    latencies, nPages, nEvents = pipeline.run(source, hide_parties=True, refresh=True, archive=archive)
+    fetcher.print_latencies(latencies)
+    metrics.write()